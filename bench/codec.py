@@ -0,0 +1,50 @@
+'''报文编解码的微基准测试
+
+逐项测量 Packet.load 与 unpack_body 的单次耗时。解包的报文模拟接收端:
+body 与 payload 拼成一段连续的数据。
+
+    python bench/codec.py
+'''
+import os
+import sys
+from argparse import ArgumentParser
+from timeit import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fastcopy.network import Flag, Packet  # noqa: E402
+
+
+def received(packet: Packet) -> Packet:
+    '''模拟接收到的报文: 数据全部位于 body 中'''
+    return Packet(packet.flag, bytes(packet.body) + bytes(packet.payload))
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-n', dest='number', type=int, default=200000,
+                        help='calls per case (default: 200000)')
+    parser.add_argument('--size', type=int, default=1024 * 1024,
+                        help='chunk size in bytes (default: 1048576)')
+    args = parser.parse_args()
+
+    chunk = b'x' * args.size
+    chunk_pkt = received(Packet.load(Flag.FILE_CHUNK, 1, 2, 0, chunk))
+    ready_pkt = received(Packet.load(Flag.FILE_READY, 1, 2, 3))
+    info_pkt = received(Packet.load(Flag.FILE_INFO, 1, 0o644, 100, 1.5,
+                                    b'x' * 16, b'some/path/file.txt'))
+    cases = [
+        ('load FILE_CHUNK', lambda: Packet.load(Flag.FILE_CHUNK, 1, 2, 0,
+                                                chunk)),
+        ('unpack FILE_CHUNK', chunk_pkt.unpack_body),
+        ('load FILE_READY', lambda: Packet.load(Flag.FILE_READY, 1, 2, 3)),
+        ('unpack FILE_READY', ready_pkt.unpack_body),
+        ('unpack FILE_INFO', info_pkt.unpack_body),
+    ]
+    for name, func in cases:
+        elapsed = timeit(func, number=args.number)
+        print(f'{name:20s} {elapsed / args.number * 1e6:8.2f} us')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+'''批量信息报文编码的基准测试
+
+合成 1000 个目录 x 999 个空文件 (共 1M 个条目) 的目录树, 按 MANIFEST_BATCH
+分批, 比较三种批量信息编码的总大小与编码、解码耗时:
+
+    varint: 当前的紧凑编码 (pack_manifest / unpack_manifest)
+    struct: 定长字段 + 完整路径 (紧凑编码之前的格式)
+    json:   每批一个 JSON 数组, 条目为字段列表, 路径为字符串, MD5 为十六进制
+
+    python bench/manifest.py
+'''
+import os
+import sys
+import json
+from argparse import ArgumentParser
+from hashlib import md5
+from struct import Struct
+from time import perf_counter, time
+from typing import Callable, Iterable, List, Sequence, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fastcopy.config import MANIFEST_BATCH  # noqa: E402
+from fastcopy.network import pack_manifest, unpack_manifest  # noqa: E402
+
+# 紧凑编码之前的格式: n_entries 后紧跟各条目, 条目以 kind 开头
+MANIFEST_HEAD = Struct('>I')  # n_entries
+# kind | dir_id | perm | len_path
+DIR_ENTRY = Struct('>BIHH')
+# kind | file_id | perm | size | mtime | chksum | len_path
+FILE_ENTRY = Struct('>BIHQd16sH')
+ENTRY_DIR, ENTRY_FILE = 0, 1
+
+
+def pack_struct(entries: Iterable[Sequence]) -> bytes:
+    n_entries, items = 0, []
+    for *fields, path in entries:
+        if len(fields) == 2:
+            items.append(DIR_ENTRY.pack(ENTRY_DIR, *fields, len(path)))
+        else:
+            items.append(FILE_ENTRY.pack(ENTRY_FILE, *fields, len(path)))
+        items.append(path)
+        n_entries += 1
+    return MANIFEST_HEAD.pack(n_entries) + b''.join(items)
+
+
+def unpack_struct(body: bytes) -> List[Tuple]:
+    entries = []
+    n_entries, = MANIFEST_HEAD.unpack_from(body)
+    offset = MANIFEST_HEAD.size
+    for _ in range(n_entries):
+        if body[offset] == ENTRY_DIR:
+            _, *fields, len_path = DIR_ENTRY.unpack_from(body, offset)
+            offset += DIR_ENTRY.size
+        else:
+            _, *fields, len_path = FILE_ENTRY.unpack_from(body, offset)
+            offset += FILE_ENTRY.size
+        entries.append((*fields, body[offset:offset + len_path]))
+        offset += len_path
+    return entries
+
+
+def pack_json(entries: Iterable[Sequence]) -> bytes:
+    items = []
+    for *fields, path in entries:
+        if len(fields) > 2:
+            fields[-1] = fields[-1].hex()
+        items.append([*fields, path.decode('utf8')])
+    return json.dumps(items, separators=(',', ':')).encode('utf8')
+
+
+def unpack_json(body: bytes) -> List[Tuple]:
+    entries = []
+    for *fields, path in json.loads(body):
+        if len(fields) > 2:
+            fields[-1] = bytes.fromhex(fields[-1])
+        entries.append((*fields, path.encode('utf8')))
+    return entries
+
+
+def synthetic_tree(n_dirs: int, n_files: int, verify: bool) -> List[Tuple]:
+    '''合成目录树的条目: 每个目录后紧跟其中的空文件'''
+    chksum = md5().digest() if verify else b''
+    mtime = time()
+    entries: List[Tuple] = []
+    for d in range(n_dirs):
+        dir_path = f'data/part-{d:04d}'.encode()
+        entries.append((len(entries), 0o755, dir_path))
+        for f in range(n_files):
+            path = dir_path + f'/file-{f:06d}.dat'.encode()
+            entries.append((len(entries), 0o644, 0, mtime + f * 1e-3,
+                            chksum, path))
+    return entries
+
+
+def bench(pack: Callable, unpack: Callable, batches: List[List[Tuple]]):
+    '''返回 (总字节数, 编码耗时, 解码耗时)'''
+    start = perf_counter()
+    bodies = [pack(batch) for batch in batches]
+    t_pack = perf_counter() - start
+
+    start = perf_counter()
+    for body in bodies:
+        unpack(body)
+    t_unpack = perf_counter() - start
+    return sum(map(len, bodies)), t_pack, t_unpack
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--dirs', type=int, default=1000,
+                        help='number of directories (default: 1000)')
+    parser.add_argument('--files', type=int, default=999,
+                        help='empty files per directory (default: 999)')
+    parser.add_argument('--verify', action='store_true',
+                        help='carry an MD5 per file, as without --no-verify')
+    args = parser.parse_args()
+
+    entries = synthetic_tree(args.dirs, args.files, args.verify)
+    batches = [entries[i:i + MANIFEST_BATCH]
+               for i in range(0, len(entries), MANIFEST_BATCH)]
+    print(f'{len(entries)} entries in {len(batches)} manifests')
+
+    cases = [
+        ('varint', pack_manifest, unpack_manifest),
+        ('struct', pack_struct, unpack_struct),
+        ('json', pack_json, unpack_json),
+    ]
+    for name, pack, unpack in cases:
+        size, t_pack, t_unpack = bench(pack, unpack, batches)
+        print(f'{name:8s} {size / 1e6:7.1f} MB  '
+              f'encode {t_pack:6.2f} s  decode {t_unpack:6.2f} s  '
+              f'({(t_pack + t_unpack) / len(entries) * 1e6:.2f} us/entry)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+'''本机 PUSH 的吞吐量与内存测试
+
+fcpd 在子进程中运行, 本进程作为发送端推送一个大文件, 统计发送端的耗时、
+CPU 时间和峰值 RSS。--mmap 与 fcp 的同名参数相同, 用于对比两种读取方式。
+
+    python bench/push.py --size 2048 --dir /var/tmp/fcp-bench
+    python bench/push.py --size 2048 --dir /var/tmp/fcp-bench --mmap
+'''
+import os
+import sys
+import socket
+import subprocess
+from argparse import ArgumentParser
+from json import dumps, loads
+from resource import RUSAGE_SELF, getrusage
+from time import monotonic, sleep
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from fastcopy.config import MMAP_MIN_SIZE  # noqa: E402
+from fastcopy.network import (Flag, Packet, Session, recv_pkt,  # noqa: E402
+                              send_pkt)
+from fastcopy.transfer import FileInfo, Sender  # noqa: E402
+
+SERVER = '''
+import sys
+sys.path.insert(0, {root!r})
+from fastcopy.server import Server
+server = Server(16, {engine!r})
+server.addr = ('127.0.0.1', {port})
+server.run()
+'''
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(port: int, engine: str) -> subprocess.Popen:
+    '''在子进程中启动 fcpd'''
+    code = SERVER.format(root=ROOT, engine=engine, port=port)
+    return subprocess.Popen([sys.executable, '-c', code])
+
+
+def connect(port: int, retries=100) -> socket.socket:
+    '''连接 fcpd, 等待其开始监听'''
+    for _ in range(retries):
+        try:
+            return socket.create_connection(('127.0.0.1', port))
+        except ConnectionRefusedError:
+            sleep(0.05)
+    raise RuntimeError('fcpd did not start')
+
+
+def make_source(path: str, size: int):
+    '''生成随机内容的源文件, 大小相同的已有文件直接复用'''
+    if os.path.exists(path) and os.path.getsize(path) == size:
+        return
+    block = 1024 * 1024 * 16
+    with open(path, 'wb') as fp:
+        for offset in range(0, size, block):
+            fp.write(os.urandom(min(block, size - offset)))
+
+
+def push(conn: socket.socket, port: int, src: str, dst: str,
+         session: Session, engine: str):
+    '''经已建立的连接按 fcp 的握手流程推送 src 到 dst'''
+    request = {'dst': dst, 'params': session.to_dict()}
+    send_pkt(conn, Packet.load(Flag.PUSH, dumps(request)))
+    session_id, params = recv_pkt(conn).unpack_body()
+    session = Session(**loads(params))
+
+    sender = Sender(session_id, [src], session, engine=engine)
+    sender.conn_pool.add(conn)
+    sender.start()
+    for _ in range(session.max_channels - 1):
+        conn = socket.create_connection(('127.0.0.1', port))
+        send_pkt(conn, Packet.load(Flag.ATTACH, session_id))
+        sender.conn_pool.add(conn)
+    sender.join()
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--size', type=int, default=2048,
+                        help='file size in MiB (default: 2048)')
+    parser.add_argument('--dir', default='.',
+                        help='directory for the source and destination files')
+    parser.add_argument('-e', dest='engine', default='thread',
+                        choices=['thread', 'asyncio'],
+                        help='connection pool engine (default: thread)')
+    parser.add_argument('-c', dest='channels', type=int, default=4,
+                        help='number of connections (default: 4)')
+    parser.add_argument('--chksum', default='crc32',
+                        help='packet checksum (default: crc32)')
+    parser.add_argument('--mmap', action='store_true',
+                        help='read the source file through mmap')
+    args = parser.parse_args()
+
+    src = os.path.join(os.path.abspath(args.dir), 'fcp-bench-src.bin')
+    dst = os.path.join(os.path.abspath(args.dir), 'fcp-bench-dst.bin')
+    size = args.size * 1024 * 1024
+    make_source(src, size)
+    if args.mmap:
+        FileInfo.mmap_min_size = MMAP_MIN_SIZE
+
+    # 不校验文件 MD5, 只测传输本身
+    session = Session(chksum=args.chksum, max_channels=args.channels,
+                      verify=False)
+    port = free_port()
+    server = start_server(port, args.engine)
+    try:
+        conn = connect(port)  # 等待 fcpd 就绪, 不计入耗时
+        rss = getrusage(RUSAGE_SELF).ru_maxrss
+        before = getrusage(RUSAGE_SELF)
+        start = monotonic()
+        push(conn, port, src, dst, session, args.engine)
+        elapsed = monotonic() - start
+        after = getrusage(RUSAGE_SELF)
+    finally:
+        server.kill()
+        if os.path.exists(dst):
+            os.remove(dst)
+
+    read = 'mmap' if args.mmap else 'read'
+    print(f'{args.engine} {read}: {elapsed:.2f}s '
+          f'{args.size / elapsed:.0f} MB/s, '
+          f'cpu user {after.ru_utime - before.ru_utime:.2f}s '
+          f'sys {after.ru_stime - before.ru_stime:.2f}s, '
+          f'max RSS {rss >> 10} -> {after.ru_maxrss >> 10} MB')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+'''发送调度策略的模拟链路测试
+
+以 socketpair 模拟若干条链路, 对端按固定带宽读取, 其中一部分慢 10 倍。
+收发缓冲区限制为 64 KiB, 使发送耗时反映链路带宽。
+发送端每批发出 batch 个数据块, 全部到达后再发下一批, 模拟接收端的文件窗口。
+
+    python bench/scheduler.py -n 8 -s 2
+'''
+import os
+import sys
+import socket
+from argparse import ArgumentParser
+from threading import Semaphore, Thread
+from time import monotonic, sleep
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fastcopy.config import LEN_HEAD  # noqa: E402
+from fastcopy.network import ConnectionPool, Flag, Packet, Session  # noqa: E402
+from fastcopy.scheduler import SCHEDULERS  # noqa: E402
+
+READ_SIZE = 1024 * 64  # 对端每次读取的字节数
+READ_INTERVAL = 0.002  # 快速链路每次读取后的间隔 (秒)
+
+
+def drain(conn: socket.socket, interval: float, pkt_len: int,
+          arrived: Semaphore):
+    '''按固定带宽读取, 每收满一个报文释放一次 arrived'''
+    n_bytes = 0
+    while True:
+        data = conn.recv(READ_SIZE)
+        if not data:
+            return
+        n_bytes += len(data)
+        while n_bytes >= pkt_len:
+            n_bytes -= pkt_len
+            arrived.release()
+        sleep(interval)
+
+
+def link(buf_size: int):
+    '''建立一条模拟链路, 返回 (发送端, 接收端)'''
+    sender, receiver = socket.socketpair()
+    for sock in (sender, receiver):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, buf_size)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, buf_size)
+    return sender, receiver
+
+
+def bench(policy: str, n_conns: int, n_slow: int, batch: int, rounds: int,
+          size: int) -> float:
+    '''返回吞吐量 (MB/s)'''
+    session = Session(max_channels=n_conns, chksum='none')
+    pool = ConnectionPool(session, policy)
+    data = os.urandom(size)
+    pkt_len = LEN_HEAD + Packet.load(Flag.FILE_CHUNK, 1, 0, 0, data).length
+    arrived = Semaphore(0)
+
+    for i in range(n_conns):
+        sender, receiver = link(READ_SIZE)
+        interval = READ_INTERVAL * (10 if i < n_slow else 1)
+        Thread(target=drain, args=(receiver, interval, pkt_len, arrived),
+               daemon=True).start()
+        pool.add(sender)
+    pool.start()
+
+    start = monotonic()
+    for r in range(rounds):
+        offsets = [(r * batch + i) * size for i in range(batch)]
+        for offset in offsets:
+            pool.send(Packet.load(Flag.FILE_CHUNK, 1, offset, 0, data))
+        for _ in offsets:
+            arrived.acquire()
+        # 代替接收端的 ACK 和 CREDIT
+        pool.inflight.ack((1, offset) for offset in offsets)
+        pool.flow.grant(pool.flow.sent)
+    elapsed = monotonic() - start
+    pool.stop()
+    return batch * rounds * size / elapsed / 1e6
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-n', dest='conns', type=int, default=8,
+                        help='number of connections (default: 8)')
+    parser.add_argument('-s', dest='slow', type=int, default=2,
+                        help='number of 10x slower connections (default: 2)')
+    parser.add_argument('-p', dest='policies', nargs='+',
+                        choices=SCHEDULERS, default=list(SCHEDULERS),
+                        help='schedulers to compare (default: all)')
+    parser.add_argument('--batch', type=int, default=8,
+                        help='chunks per batch (default: 8)')
+    parser.add_argument('--rounds', type=int, default=25,
+                        help='number of batches (default: 25)')
+    parser.add_argument('--size', type=int, default=256 * 1024,
+                        help='chunk size in bytes (default: 262144)')
+    args = parser.parse_args()
+
+    for policy in args.policies:
+        rate = bench(policy, args.conns, args.slow, args.batch, args.rounds,
+                     args.size)
+        print(f'{args.conns} conns, {args.slow} slow: '
+              f'{policy:10s} {rate:6.1f} MB/s')
+
+
+if __name__ == '__main__':
+    main()
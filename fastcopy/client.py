@@ -4,15 +4,17 @@ import os
 import sys
 import logging
 import signal
+import ssl
 from argparse import ArgumentParser, RawDescriptionHelpFormatter
 from functools import partial, wraps
 from getpass import getpass, getuser
-from json import dumps
+from json import dumps, loads
+from math import ceil
 from os.path import abspath
 from socket import create_connection
 from textwrap import dedent
 from threading import Thread
-from time import sleep
+from time import monotonic, sleep
 from typing import Any, Dict, List, Tuple
 
 from paramiko import Channel, Transport, SSHConfig
@@ -22,9 +24,12 @@ from rich.live import Live
 from rich.progress import Progress, SpinnerColumn, TextColumn
 from rich.table import Table
 
-from .config import SERVER_ADDR, SSH_MUX, TIMEOUT
-from .network import Flag, Packet, send_pkt, recv_pkt
-from .transfer import Sender, Receiver, trans_progress
+from .config import (SERVER_ADDR, SSH_MUX, TIMEOUT, CHUNK_SIZE,
+                     MMAP_MIN_SIZE)
+from .network import (CHECKSUMS, COMPRESSIONS, ENGINES, TRANSPORTS, Flag,
+                      Packet, Session, fingerprint, send_pkt, recv_pkt)
+from .sockopt import tune_socket
+from .transfer import FileInfo, Sender, Receiver, trans_progress
 
 
 conn_progress = Progress(
@@ -54,10 +59,76 @@ def retry(num, *, wait, exceptions=(Exception,)):
     return deco
 
 
+class WidthTuner:
+    '''连接数调优 (爬山法)
+
+    每轮根据实测吞吐量决定增减连接数:
+        - 加宽后吞吐量提升明显, 则继续加宽, 步长加倍 (慢启动)
+        - 加宽后没有明显提升, 说明多出的连接只会加剧争用, 撤销这次加宽
+        - 稳定若干轮后交替试探 +1 / -1, 以适应传输过程中的变化;
+          收窄后吞吐量基本不变则保持收窄
+    '''
+    min_gain = 0.1  # 吞吐量提升超过 10% 才算有效
+    hold_rounds = 5  # 稳定后间隔多少轮再试探
+
+    def __init__(self, max_width: int):
+        self.max_width = max_width
+        self.width = 1
+        self.step = 1
+        self.last_delta = 0  # 上一轮的调整量
+        self.last_rate = 0.0  # 上一轮调整前的吞吐量
+        self.hold = 0  # 剩余的稳定轮数
+        self.probe_up = True  # 下次试探的方向
+
+    def _resize(self, delta: int, rate: float, probe=True) -> int:
+        '''调整连接数, probe 为 False 时 (撤销上次调整) 下一轮不再评估'''
+        delta = max(1, min(self.width + delta, self.max_width)) - self.width
+        self.width += delta
+        self.last_delta = delta if probe else 0
+        self.last_rate = rate
+        return delta
+
+    def update(self, rate: float) -> int:
+        '''输入本轮的吞吐量, 返回连接数的调整量'''
+        if rate <= 0:
+            return 0  # 没有数据传输, 无从判断
+
+        gained = rate > self.last_rate * (1 + self.min_gain)
+        if self.last_delta > 0:
+            if gained:
+                self.step *= 2
+                return self._resize(self.step, rate)
+            # 加宽无效, 撤销
+            self.step = 1
+            self.hold = self.hold_rounds
+            return self._resize(-self.last_delta, rate, probe=False)
+
+        if self.last_delta < 0:
+            self.hold = self.hold_rounds
+            if rate < self.last_rate * (1 - self.min_gain / 2):
+                # 收窄后吞吐量下降, 恢复
+                return self._resize(-self.last_delta, rate, probe=False)
+            return self._resize(0, rate)
+
+        if self.hold > 0:
+            self.hold -= 1
+            self.last_rate = rate
+            return 0
+
+        # 试探
+        if self.probe_up and self.width < self.max_width or self.width == 1:
+            delta = 1
+        else:
+            delta = -1
+        self.probe_up = not self.probe_up
+        return self._resize(delta, rate)
+
+
 class Client:
     default_port = 22
     default_dir = os.path.expanduser('~/.ssh')
     default_config = os.path.join(default_dir, 'config')
+    tune_interval = 1  # 调整连接数的间隔 (秒)
 
     def __init__(self, cli_parser: ArgumentParser):
         args = cli_parser.parse_args()
@@ -91,10 +162,26 @@ class Client:
         self.include = args.include
         self.exclude = [p for p in args.exclude.split(',') if p]
         self.n_tunnel = args.num
-        self.n_channel = self.n_tunnel * SSH_MUX
+        self.n_mux = args.mux
+        self.n_channel = self.n_tunnel * self.n_mux
+        self.engine = args.engine
+        self.fixed = args.fixed  # 是否在开始时建立全部连接
+        self.bandwidth = args.bandwidth  # 链路带宽 (Mbit/s), 用于计算缓冲区
+        self.rtt = args.rtt / 1000 if args.rtt else None  # 往返时延 (秒)
+        if args.mmap:
+            FileInfo.mmap_min_size = MMAP_MIN_SIZE  # 上传时大文件通过 mmap 读取
         self.conn_tid = conn_progress.add_task('Connecting',
                                                total=self.n_channel)
 
+        # the session params proposed to the server
+        self.session = Session(chunk_size=args.chunk_size * 1024,
+                               chksum=args.chksum,
+                               compress=args.compress,
+                               max_channels=self.n_channel,
+                               verify=args.verify,
+                               transport=args.transport,
+                               congestion=args.congestion)
+
         # the ssh tunnels
         self.tunnels: Dict[Transport, List[Channel]] = {}
 
@@ -201,12 +288,18 @@ class Client:
 
         return pkey_paths
 
+    def tune_socket(self, sock):
+        '''调优 SSH 隧道的 TCP 连接 (直连的连接由连接池调优)'''
+        tuning = tune_socket(sock, self.session.sock_buf,
+                             self.session.congestion, self.session.chunk_size)
+        logging.debug(f'[b]fcp[/b]: {tuning}')
+
     @retry(3, wait=0.3, exceptions=ConnectionResetError)
     def create_transport(self, sock, user, pkey, password):
         if isinstance(sock, tuple):
             sock = create_connection(sock)
+            self.tune_socket(sock)
         tp = Transport(sock)
-        tp.use_compression(True)
         tp.set_keepalive(60)
         try:
             tp.connect(username=user, pkey=pkey, password=password)
@@ -253,8 +346,18 @@ class Client:
 
         # connect to ssh server (just connect, not auth)
         addr = (self.host, self.port)
+        t_start = monotonic()
         sock = create_connection(addr)
 
+        # 以 TCP 建连耗时估算往返时延, 按带宽时延积设置缓冲区
+        if self.rtt is None:
+            self.rtt = monotonic() - t_start
+        if self.bandwidth:
+            self.session.sock_buf = int(self.bandwidth * 1e6 / 8 * self.rtt)
+        logging.debug(f'[b]fcp[/b]: rtt {self.rtt * 1000:.1f} ms, '
+                      f'socket buffer {self.session.sock_buf}')
+        self.tune_socket(sock)
+
         # try the pkeys one by one
         for _path in pkey_paths:
             logging.debug(f'test pkey: {_path}')
@@ -275,14 +378,37 @@ class Client:
         logging.error('[b]fcp[/b]: failed to create SSH tunnel')
         sys.exit(1)
 
-    def handshake(self, channel, remote_path: str):
+    def handshake(self, channel, request: dict):
         '''握手'''
-        conn_pkt = Packet.load(self.action, remote_path)
+        request['params'] = self.session.to_dict()
+        body = dumps(request, ensure_ascii=False, separators=(',', ':'))
+        conn_pkt = Packet.load(self.action, body)
         send_pkt(channel, conn_pkt)
         session_pkt = recv_pkt(channel)
-        session_id, = session_pkt.unpack_body()
+        if session_pkt.flag == Flag.EXCEPTION:
+            msg, = session_pkt.unpack_body()
+            raise ValueError(f'the server refused the session: {msg}')
+
+        session_id, params = session_pkt.unpack_body()
         logging.info(f'[b]fcp[/b]: Channel-{id(channel):x} connected')
 
+        # 以服务器协商后的参数为准
+        session = Session(**loads(params))
+        for name, value in session.to_dict().items():
+            if name in Session.server_params:
+                continue
+            if value != getattr(self.session, name):
+                logging.warning(f'[b]fcp[/b]: the server changed the session '
+                                f'param `{name}` to `{value}`.')
+        self.session = session
+        logging.debug(f'[b]fcp[/b]: {session}')
+
+        # 服务器限制了连接数时, 减少需要建立的隧道
+        if session.max_channels < self.n_channel:
+            self.n_channel = session.max_channels
+            self.n_tunnel = ceil(self.n_channel / self.n_mux)
+            conn_progress.update(self.conn_tid, total=self.n_channel)
+
         return session_id
 
     def create_attached_channels(self, tp, conn_pool, session_id):
@@ -295,14 +421,41 @@ class Client:
             conn_pool.add(channel)
             logging.info(f'[b]fcp[/b]: Channel-{id(channel):x} connected')
 
-        for _ in range(SSH_MUX - len(channels)):
+        for _ in range(self.n_mux - len(channels)):
             thr = Thread(target=_attache_channel, daemon=True)
             thr.start()
 
+    def create_direct_connection(self):
+        '''直连服务器的数据端口, 不经过 SSH
+
+        TLS 证书的指纹已由服务器经 SSH 告知, 以此代替 CA 校验
+        '''
+        sock = create_connection((self.host, self.session.data_port), TIMEOUT)
+        if self.session.transport == 'tls':
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+            sock = context.wrap_socket(sock)
+            cert = sock.getpeercert(binary_form=True)
+            if fingerprint(cert) != self.session.fingerprint:
+                sock.close()
+                raise ssl.SSLError('the certificate of the data port does '
+                                   'not match the fingerprint')
+        conn_progress.update(self.conn_tid, advance=1)
+        return sock
+
     def attached_connect(self, conn_pool, session_id, pkey, password):
         '''后续连接'''
         addr = (self.host, self.port)
 
+        if self.session.transport != 'ssh':
+            # 直连时无需建立隧道, 直接打开其余的连接
+            for _ in range(self.n_channel - 1):
+                Thread(target=self.open_attached_channel,
+                       args=(conn_pool, session_id, pkey, password),
+                       daemon=True).start()
+            return
+
         @retry(3, wait=0.3)
         def _attache():
             tp = self.create_transport(addr, self.username, pkey, password)
@@ -318,6 +471,84 @@ class Client:
             thr.start()
             sleep(0.3)
 
+    def open_attached_channel(self, conn_pool, session_id, pkey, password):
+        '''新增一个后续连接: 直连数据端口, 或优先复用未满的隧道, 否则新建隧道'''
+        if self.session.transport != 'ssh':
+            try:
+                channel = self.create_direct_connection()
+            except OSError as e:
+                logging.error(f'[b]fcp[/b]: connect to the data port failed '
+                              f'due to {e}')
+                return None
+            send_pkt(channel, Packet.load(Flag.ATTACH, session_id))
+            if not conn_pool.add(channel):
+                self.close_attached_channel(conn_pool, channel)
+                return None
+            logging.info(f'[b]fcp[/b]: Channel-{id(channel):x} connected '
+                         f'directly')
+            return channel
+
+        for tp, channels in self.tunnels.items():
+            if len(channels) < self.n_mux and tp.is_active():
+                break
+        else:
+            addr = (self.host, self.port)
+            tp = self.create_transport(addr, self.username, pkey, password)
+            if not tp:
+                return None
+
+        channel = self.create_channel(tp)
+        send_pkt(channel, Packet.load(Flag.ATTACH, session_id))
+        if not conn_pool.add(channel):
+            self.close_attached_channel(conn_pool, channel)
+            return None
+        logging.info(f'[b]fcp[/b]: Channel-{id(channel):x} connected')
+        return channel
+
+    def close_attached_channel(self, conn_pool, channel):
+        '''关闭一个后续连接 (由连接池排空后关闭), 隧道上没有其他通道时一并关闭'''
+        conn_pool.remove(channel)
+        for tp, channels in list(self.tunnels.items()):
+            if channel in channels:
+                channels.remove(channel)
+                if not channels:
+                    tp.close()
+                    self.tunnels.pop(tp)
+                break
+        conn_progress.update(self.conn_tid, advance=-1)
+        logging.info(f'[b]fcp[/b]: Channel-{id(channel):x} closed')
+
+    def autoscale(self, porter, session_id, pkey, password):
+        '''根据实测吞吐量动态调整连接数
+
+        从首个连接开始, 每隔 tune_interval 秒测量一次吞吐量, 由 WidthTuner
+        决定增减连接, 最多不超过协商的连接数。关闭连接前连接池先将其排空,
+        其上已发出的报文不会丢失。
+        '''
+        conn_pool = porter.conn_pool
+        tuner = WidthTuner(self.n_channel)
+        attached: List[Channel] = []  # 后续连接, 按打开的先后排列
+        n_bytes, t_start = conn_pool.traffic, monotonic()
+        while porter.is_alive():
+            sleep(self.tune_interval)
+            rate = (conn_pool.traffic - n_bytes) / (monotonic() - t_start)
+            delta = tuner.update(rate)
+            for _ in range(delta):
+                channel = self.open_attached_channel(conn_pool, session_id,
+                                                     pkey, password)
+                if channel is None:
+                    tuner.width -= 1
+                else:
+                    attached.append(channel)
+            for _ in range(min(-delta, len(attached))):
+                self.close_attached_channel(conn_pool, attached.pop())
+
+            if delta:
+                logging.debug(f'[b]fcp[/b]: throughput {rate / 1048576:.1f} '
+                              f'MB/s, resize channels to {tuner.width}')
+            # 调整完毕后重新计时
+            n_bytes, t_start = conn_pool.traffic, monotonic()
+
     def start(self):
         with Live(progress_table, refresh_per_second=10):
             try:
@@ -325,24 +556,32 @@ class Client:
                 first_channel = self.create_channel(tp)
 
                 if self.action == Flag.PULL:
-                    remote_path = dumps({
+                    session_id = self.handshake(first_channel, {
                         'srcs': self.srcs,
                         'include': self.include,
                         'exclude': self.exclude
-                    }, ensure_ascii=False, separators=(',', ':'))
-                    session_id = self.handshake(first_channel, remote_path)
-                    porter = Receiver(session_id, self.dst, self.n_channel)
+                    })
+                    porter = Receiver(session_id, self.dst, self.session,
+                                      self.engine)
                 else:
-                    session_id = self.handshake(first_channel, self.dst)
-                    porter = Sender(session_id, self.srcs, self.n_channel,
-                                    self.include, self.exclude)
+                    session_id = self.handshake(first_channel, {
+                        'dst': self.dst
+                    })
+                    porter = Sender(session_id, self.srcs, self.session,
+                                    self.include, self.exclude, self.engine)
 
                 porter.conn_pool.add(first_channel)
                 porter.start()
 
                 # create attached connections
-                t = Thread(target=self.attached_connect,
-                           args=(porter.conn_pool, session_id, pkey, password))
+                if self.fixed:
+                    t = Thread(target=self.attached_connect,
+                               args=(porter.conn_pool, session_id, pkey,
+                                     password))
+                else:
+                    t = Thread(target=self.autoscale,
+                               args=(porter, session_id, pkey, password),
+                               daemon=True)
                 t.start()
 
                 porter.join()
@@ -386,9 +625,69 @@ def main():
     parser.add_argument('-n', dest='num', type=int, default=8,
                         help='Max number of SSH tunnels (default: %(default)s)')
 
+    parser.add_argument('-m', dest='mux', type=int, default=SSH_MUX,
+                        help=('Number of channels per SSH tunnel '
+                              '(default: %(default)s)'))
+
+    parser.add_argument('--fixed', action='store_true',
+                        help=('open all `-n` x `-m` channels at start instead '
+                              'of scaling them by the measured throughput'))
+
+    parser.add_argument('-s', dest='chunk_size', type=int, metavar='KB',
+                        default=CHUNK_SIZE // 1024,
+                        help='Size of data chunks in KB (default: %(default)s)')
+
     parser.add_argument('-v', dest='verbose', action='count', default=0,
                         help='Verbose mode (default: disable)')
 
+    parser.add_argument('--chksum', type=str, metavar='ALGORITHM',
+                        default='crc32', choices=list(CHECKSUMS),
+                        help=('packet checksum algorithm, SSH has its own MAC '
+                              'so `none` is safe here (default: %(default)s)'))
+
+    parser.add_argument('--compress', type=str, metavar='METHOD',
+                        default='zlib', choices=list(COMPRESSIONS),
+                        help=('compress data chunks in parallel, files that '
+                              'do not compress well are sent as is '
+                              '(default: %(default)s)'))
+
+    parser.add_argument('--no-verify', dest='verify', action='store_false',
+                        help=('skip the MD5 check of files, compare size and '
+                              'mtime only'))
+
+    parser.add_argument('--engine', type=str, metavar='ENGINE',
+                        default='thread', choices=list(ENGINES),
+                        help=('connection pool engine, `asyncio` drives all '
+                              'channels with one thread (default: %(default)s)'))
+
+    parser.add_argument('--transport', type=str, metavar='MODE',
+                        default='ssh', choices=TRANSPORTS,
+                        help=('how to carry the data connections: `tcp` or '
+                              '`tls` connect to the data port of fcpd '
+                              'directly after the session is set up over SSH, '
+                              '`tcp` is for trusted networks only '
+                              '(default: %(default)s)'))
+
+    parser.add_argument('--bandwidth', type=float, metavar='MBIT', default=0,
+                        help=('bandwidth of the link in Mbit/s, socket '
+                              'buffers are sized to the bandwidth-delay '
+                              'product. Kernel autotuning if not given'))
+
+    parser.add_argument('--rtt', type=float, metavar='MS', default=0,
+                        help=('round-trip time in ms for the bandwidth-delay '
+                              'product (default: measured on SSH connect)'))
+
+    parser.add_argument('--congestion', type=str, metavar='ALGORITHM',
+                        default='',
+                        help=('TCP congestion control algorithm, e.g. `bbr`, '
+                              'used if both ends support it'))
+
+    parser.add_argument('--mmap', action='store_true',
+                        help=('read large local files through mmap when '
+                              'uploading, saving a copy per chunk. fcp is '
+                              'killed by SIGBUS if such a file is truncated '
+                              'during the transfer'))
+
     parser.add_argument('--include', type=str, metavar='PATTERN', default='*',
                         help='include files matching PATTERN')
 
@@ -1,5 +1,15 @@
 SERVER_ADDR = ('127.0.0.1', 7523)
-CHUNK_SIZE = 1024 * 4  # 默认数据块大小 (单位: 字节)
-SSH_MUX = 2
+CHUNK_SIZE = 1024 * 1024  # 默认数据块大小 (单位: 字节)
+MIN_CHUNK_SIZE = 1024 * 4  # 数据块大小下限
+MAX_CHUNK_SIZE = 1024 * 1024 * 16  # 数据块大小上限
+SSH_MUX = 2  # 每个 SSH 隧道上默认开启的通道数
+MAX_CHANNELS = 128  # 一个会话的最大连接数
+FILE_WINDOW = 8  # 接收端允许同时写入的文件数
+CREDIT_WINDOW = 1024 * 1024 * 64  # 已发出但接收端尚未处理的数据块字节数上限
+MAX_SOCK_BUF = 1024 * 1024 * 256  # TCP 收发缓冲区上限
 TIMEOUT = 60 * 5  # 全局超时时间
-LEN_HEAD = 7
+PROTOCOL_VERSION = 3  # 报文格式版本
+LEN_HEAD = 14
+MAX_BODY_SIZE = MAX_CHUNK_SIZE + 1024 * 64  # 单个报文 body 长度上限
+MANIFEST_BATCH = 1000  # 每个批量信息报文最多包含的条目数
+MMAP_MIN_SIZE = 1024 * 1024 * 8  # 开启 --mmap 时, 不小于此大小的文件通过 mmap 读取
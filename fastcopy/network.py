@@ -1,18 +1,55 @@
+import asyncio
+import fcntl
 import logging
+import os
 from binascii import crc32
+from collections import Counter
+from contextlib import closing
+from hashlib import sha256
+from concurrent.futures import ThreadPoolExecutor
+from zlib import adler32
 from enum import IntEnum
+from os.path import commonprefix
 from paramiko import Channel
-from queue import Empty, Queue
-from selectors import SelectSelector, EVENT_WRITE
-from socket import socket, error as SocketError
-from struct import pack, unpack
-from threading import Event, Thread
-from time import sleep
-from typing import Any, NamedTuple, Set, Tuple, Union
+from itertools import count
+from queue import Empty, PriorityQueue
+from select import POLLIN, POLLOUT, poll
+from socket import socket, error as SocketError, timeout as TimeoutError
+from ssl import SSLSocket, SSLWantReadError, SSLWantWriteError
+from struct import Struct, pack, unpack
+from threading import Condition, Event, Lock, Semaphore, Thread
+from time import monotonic
+from typing import (Any, Callable, Dict, Generator, Iterable, List, Optional,
+                    Sequence, Set, Tuple, Union)
 
-from .config import TIMEOUT, LEN_HEAD
+from .config import (TIMEOUT, LEN_HEAD, MAX_BODY_SIZE, PROTOCOL_VERSION,
+                     CHUNK_SIZE, MIN_CHUNK_SIZE, MAX_CHUNK_SIZE,
+                     MAX_CHANNELS, FILE_WINDOW, CREDIT_WINDOW, MAX_SOCK_BUF)
+from .scheduler import SCHEDULERS, Scheduler
+from .sockopt import SocketTuning, congestion_controls, tune_socket
 
 Connection = Union[socket, Channel]
+Buffer = Union[bytes, bytearray, memoryview]
+
+HEAD = Struct('>BBIII')  # version | flag | seq | chksum | length
+
+# 批量信息报文的条目标识
+ENTRY_FILE = 0b01  # 为文件 (否则为目录)
+ENTRY_CHKSUM = 0b10  # 附带 16 字节 MD5
+
+# 可协商的报文校验算法。SSH 通道自带 MAC, 可选用更轻量的校验或直接关闭
+CHECKSUMS: Dict[str, Optional[Callable[..., int]]] = {
+    'crc32': crc32,
+    'adler32': adler32,
+    'none': None,
+}
+
+# 数据连接的传输方式: 经 SSH 通道转发, 或直连服务器的数据端口 (明文 / TLS)
+TRANSPORTS = ('ssh', 'tcp', 'tls')
+
+# 可协商的数据块压缩算法, 其序号即 FILE_CHUNK 报文中的 codec 字段
+COMPRESSIONS = ('none', 'zlib')
+CODEC_RAW = COMPRESSIONS.index('none')
 
 
 class Flag(IntEnum):
@@ -28,273 +65,1735 @@ class Flag(IntEnum):
     FILE_CHUNK = 10  # 数据传输
     DONE = 11        # 完成
     EXCEPTION = 12   # 异常退出
+    MANIFEST = 13    # 批量目录、文件信息
+    CREDIT = 14      # 发送额度
+    ACK = 15         # 数据块确认
+    CTRL_ACK = 16    # 控制报文确认
+    DETACH = 17      # 连接下线
 
     @classmethod
     def contains(cls, member: object) -> bool:
         return member in cls.__members__.values()
 
 
-class Packet(NamedTuple):
-    flag: Flag
-    body: bytes
+class FileRange:
+    '''文件中的一段数据
+
+    作为 payload 时, 经普通 socket 发送可由 os.sendfile 直接从页缓存写入内核,
+    不经过用户空间; 其他连接在发送时才用 os.pread 读出。
+    区间只记录文件路径, 每次发送时打开文件、发完即关闭, 等待确认 (或重发) 的
+    区间不占用文件描述符, 大量小文件也不会耗尽描述符。
+    接收端由 os.splice 直接写入文件的数据块也以此表示, 此时 path 为 None。
+    文件在发送前被截短或删除时以 0 补足, 保持报文边界 (MD5 校验会发现)。
+    '''
+    __slots__ = ('path', 'offset', 'length')
+
+    def __init__(self, path: Optional[str], offset: int, length: int):
+        self.path = path
+        self.offset = offset
+        self.length = length
+
+    def __len__(self) -> int:
+        return self.length
+
+    def open(self) -> Optional[int]:
+        '''打开文件, 返回文件描述符 (由调用方关闭), 无法打开时返回 None'''
+        try:
+            return os.open(self.path, os.O_RDONLY)
+        except OSError as e:
+            logging.warning(f'[Send] cannot read {self.path}: {e}')
+            return None
+
+    def read(self) -> bytes:
+        fd = self.open()
+        if fd is None:
+            return bytes(self.length)
+        try:
+            data = os.pread(fd, self.length, self.offset)
+        finally:
+            os.close(fd)
+        return data.ljust(self.length, b'\0')
+
+
+Payload = Union[Buffer, FileRange]
+
+
+class Packet:
+    '''数据报文
+
+    body 为报文的定长字段部分, payload 为附带的大块数据 (如文件数据块)。
+    发送时二者分别交给连接, payload 不会再被拷贝。
+    seq 为连接池给控制报文的编号 (0 为不编号), 对端据此确认和去重。
+    '''
+    __slots__ = ('flag', 'body', 'payload', 'chksum', 'seq')
+
+    def __init__(self, flag: Flag, body: Buffer, payload: Payload = b'',
+                 chksum: Optional[int] = None, seq: int = 0):
+        self.flag = flag
+        self.body = body
+        self.payload = payload
+        self.chksum = chksum  # 校验和, 首次使用时计算
+        self.seq = seq
 
     def __str__(self) -> str:
-        return (f'Packet: {self.flag.name} '
-                f'len={self.length} '
-                f'chk={self.chksum:08x}')
+        chk = '-' if self.chksum is None else f'{self.chksum:08x}'
+        return f'Packet: {self.flag.name} len={self.length} chk={chk}'
 
     @property
     def length(self) -> int:
-        return len(self.body)
+        return len(self.body) + len(self.payload)
 
-    @property
-    def chksum(self) -> int:
-        return crc32(self.body)
+    def checksum(self, algorithm='crc32') -> int:
+        '''计算校验和, 每个报文只计算一次'''
+        if self.chksum is None:
+            func = CHECKSUMS[algorithm]
+            if func is None:
+                self.chksum = 0
+            else:
+                self.chksum = func(self.read_payload(), func(self.body))
+        return self.chksum
+
+    def read_payload(self) -> Buffer:
+        '''payload 的数据, FileRange 需从文件中读出'''
+        if isinstance(self.payload, FileRange):
+            return self.payload.read()
+        return self.payload
 
     @staticmethod
     def load(flag: Flag, *args) -> 'Packet':
         '''将包体封包'''
-        if flag == Flag.PULL or flag == Flag.PUSH:
-            if isinstance(args[0], bytes):
-                body = args[0]
-            else:
-                body = str(args[0]).encode('utf8')
-        elif flag == Flag.SID or flag == Flag.ATTACH:
-            body = pack('>16s', *args)
-        elif flag == Flag.MONOFILE:
-            body = pack('>?', *args)
-        elif flag == Flag.DIR_INFO:
-            length = len(args[-1])
-            body = pack(f'>IH{length}s', *args)
-        elif flag == Flag.FILE_INFO:
-            length = len(args[-1])
-            body = pack(f'>IHQd16s{length}s', *args)
-        elif flag == Flag.FILE_COUNT:
-            body = pack('>I', *args)
-        elif flag == Flag.FILE_READY:
-            body = pack('>I', *args)
-        elif flag == Flag.FILE_CHUNK:
-            length = len(args[-1])
-            body = pack(f'>2I{length}s', *args)
-        elif flag == Flag.DONE:
-            body = pack('>?', True)
-        elif flag == Flag.EXCEPTION:
-            body = str(args[0]).encode('utf8')
-        else:
-            raise ValueError(f'{flag} is not a valid Flag')
-        return Packet(flag, body)
+        try:
+            codec = CODECS[flag]
+        except KeyError:
+            raise ValueError(f'{flag} is not a valid Flag') from None
+        return Packet(flag, *codec.encode(*args))
 
-    def pack(self) -> bytes:
+    def head(self, algorithm='crc32') -> bytes:
+        '''封装报头'''
+        return HEAD.pack(PROTOCOL_VERSION, self.flag, self.seq,
+                         self.checksum(algorithm), self.length)
+
+    def pack(self, algorithm='crc32') -> bytes:
         '''封包'''
-        fmt = f'>BIH{self.length}s'
-        return pack(fmt, self.flag, self.chksum, self.length, self.body)
+        return b''.join((self.head(algorithm), self.body, self.read_payload()))
 
     @staticmethod
-    def unpack_head(head: bytes) -> Tuple[Flag, int, int]:
-        '''解析 head'''
-        flag, chksum, length = unpack('>BIH', head)
-        if not Flag.contains(flag):
-            raise PacketError
+    def unpack_head(head: bytes) -> Tuple[Flag, int, int, int]:
+        '''解析 head, 返回 flag, seq, chksum, length'''
+        version, flag, seq, chksum, length = HEAD.unpack(head)
+        if version != PROTOCOL_VERSION:
+            raise VersionError(f'unsupported protocol version: {version}')
+        elif not Flag.contains(flag):
+            raise PacketError(f'unknown packet flag: {flag}')
+        elif length > MAX_BODY_SIZE:
+            raise PacketError(f'packet body too large: {length}')
         else:
-            return Flag(flag), chksum, length
+            return Flag(flag), seq, chksum, length
 
     def unpack_body(self) -> Tuple[Any, ...]:
-        '''将 body 解包'''
-        if self.flag == Flag.PULL or self.flag == Flag.PUSH:
-            return (self.body.decode('utf-8'),)  # dest path
+        '''将 body 解包 (仅用于接收到的报文, 其数据全部位于 body 中)'''
+        try:
+            codec = CODECS[self.flag]
+        except KeyError:
+            raise ValueError(f'{self.flag} is not a valid Flag') from None
+        return codec.decode(self.body)
+
+    def is_valid(self, chksum: int, algorithm='crc32'):
+        '''是否是有效的包体'''
+        return self.checksum(algorithm) == chksum
+
+
+class PacketError(Exception):
+    pass
+
+
+class VersionError(PacketError):
+    '''对端的协议版本与本端不同'''
+
+
+class Session:
+    '''会话参数
+
+    由客户端在 PUSH / PULL 申请中提出, 服务器协商后随 SID 回传,
+    此后收发双方均按协商的结果工作, 不再依赖各自 config 中的常量
+    '''
+    __slots__ = ('version', 'chunk_size', 'chksum', 'compress',
+                 'file_window', 'credit_window', 'max_channels', 'verify',
+                 'transport', 'data_port', 'fingerprint', 'sock_buf',
+                 'congestion')
+    # 由服务器填写, 客户端无需提出的参数
+    server_params = ('data_port', 'fingerprint')
+
+    def __init__(self, **params):
+        self.version = PROTOCOL_VERSION  # 协议版本
+        self.chunk_size = CHUNK_SIZE     # 数据块大小
+        self.chksum = 'crc32'            # 报文校验算法
+        self.compress = 'none'           # 数据块压缩算法
+        self.file_window = FILE_WINDOW   # 接收端同时写入的文件数
+        self.credit_window = CREDIT_WINDOW  # 数据块发送额度 (字节)
+        self.max_channels = 16           # 最大连接数
+        self.verify = True               # 是否校验文件 MD5
+        self.transport = 'ssh'           # 后续连接的传输方式
+        self.data_port = 0               # 服务器的直连数据端口
+        self.fingerprint = ''            # 服务器 TLS 证书的 SHA-256 指纹
+        self.sock_buf = 0                # TCP 收发缓冲区 (字节), 0 为内核自动调节
+        self.congestion = ''             # TCP 拥塞控制算法, 空为系统默认
 
-        elif self.flag == Flag.SID or self.flag == Flag.ATTACH:
-            return unpack('>16s', self.body)  # Worker ID
+        # 忽略不认识的参数, 以兼容更新版本的对端
+        for name, value in params.items():
+            if name in self.__slots__:
+                setattr(self, name, value)
 
-        elif self.flag == Flag.MONOFILE:
-            return unpack('>?', self.body)  # is monofile
+    def __str__(self) -> str:
+        params = ' '.join(f'{k}={v}' for k, v in self.to_dict().items())
+        return f'Session({params})'
+
+    def to_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def negotiate(self, max_channels=MAX_CHANNELS,
+                  transports: Sequence[str] = ('ssh',)) -> 'Session':
+        '''服务端协商: 将对端提出的参数限制在本端支持的范围内
 
-        elif self.flag == Flag.DIR_INFO:
-            # file_id | perm | path
-            #   4B    |  2B  |  ...
-            fmt = f'>IH{self.length - 6}s'
-            return unpack(fmt, self.body)
+        transports 为服务器开启的传输方式, 不支持时退回 SSH
+        (协议版本已由报头检查, 不同时 WatchDog 直接拒绝)
+        '''
+        chunk_size = max(MIN_CHUNK_SIZE, min(int(self.chunk_size),
+                                             MAX_CHUNK_SIZE))
+        return Session(
+            chunk_size=chunk_size,
+            chksum=self.chksum if self.chksum in CHECKSUMS else 'crc32',
+            compress=self.compress if self.compress in COMPRESSIONS else 'none',
+            file_window=max(1, min(int(self.file_window), 64)),
+            # 额度至少能容纳 4 个数据块, 以免额度未归还时双方互相等待
+            credit_window=max(chunk_size * 4,
+                              min(int(self.credit_window), 1024 ** 3)),
+            max_channels=max(1, min(int(self.max_channels), max_channels)),
+            verify=bool(self.verify),
+            transport=self.transport if self.transport in transports else 'ssh',
+            sock_buf=max(0, min(int(self.sock_buf), MAX_SOCK_BUF)),
+            congestion=(self.congestion
+                        if self.congestion in congestion_controls() else ''),
+        )
 
-        elif self.flag == Flag.FILE_INFO:
-            # file_id | perm | size | mtime | chksum | path
-            #   4B    |  2B  |  8B  |  8B   |  16B   |  ...
-            fmt = f'>IHQd16s{self.length - 38}s'
-            return unpack(fmt, self.body)
 
-        elif self.flag == Flag.FILE_COUNT:
-            return unpack('>I', self.body)  # file count
+def pack_varint(value: int, buf: bytearray):
+    '''将非负整数以 varint 编码写入 buf'''
+    while value >= 0x80:
+        buf.append(value & 0x7f | 0x80)
+        value >>= 7
+    buf.append(value)
 
-        elif self.flag == Flag.FILE_READY:
-            return unpack('>I', self.body)  # file id
 
-        elif self.flag == Flag.FILE_CHUNK:
-            # file_id |  seq  | chunk
-            #    4B   |  4B   |  ...
-            fmt = f'>2I{self.length - 8}s'
-            return unpack(fmt, self.body)
+def unpack_varint(buf: Buffer, offset: int) -> Tuple[int, int]:
+    '''从 buf 的 offset 处解析一个 varint, 返回 (数值, 新的 offset)'''
+    value = shift = 0
+    while True:
+        byte = buf[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
 
-        elif self.flag == Flag.DONE:
-            return unpack('>?', self.body)
 
-        elif self.flag == Flag.EXCEPTION:
-            return (self.body.decode('utf-8'),)
+def pack_manifest(entries: Iterable[Sequence]) -> bytes:
+    '''将多个目录、文件信息紧凑地编码为一个报文体
 
+    目录信息为 (dir_id, perm, path), 文件信息为
+    (file_id, perm, size, mtime, chksum, path)。
+
+    - 整数均为 varint, id 与 mtime (微秒) 存储为与上一条目的差值
+    - 上级目录已在本报文中出现时, 路径只记录 上级目录 id + 文件名
+    - 文件名采用前缀压缩: 只记录与上一条目相同的前缀长度及剩余部分
+    - 没有 MD5 时 (不校验文件), 不占用空间
+    '''
+    buf = bytearray()
+    n_entries = prev_id = prev_mtime = 0
+    prev_name = b''
+    dirs: Dict[bytes, int] = {}  # 本报文中出现过的目录: path -> dir_id
+    for *fields, path in entries:
+        parent, _, name = path.rpartition(b'/')
+        parent_ref = dirs.get(parent, -1) + 1 if parent else 0
+        if not parent_ref:
+            name = path
+
+        if len(fields) == 2:
+            entry_id, perm = fields
+            buf.append(0)
+            dirs[path] = entry_id
         else:
-            raise ValueError(f'{self.flag} is not a valid Flag')
+            entry_id, perm, size, mtime, chksum = fields
+            buf.append(ENTRY_FILE | ENTRY_CHKSUM if chksum else ENTRY_FILE)
 
-    def is_valid(self, chksum: int):
-        '''是否是有效的包体'''
-        return self.chksum == chksum
+        pack_varint(entry_id - prev_id, buf)
+        pack_varint(perm, buf)
+        pack_varint(parent_ref, buf)
 
+        n_shared = len(commonprefix((prev_name, name)))
+        pack_varint(n_shared, buf)
+        pack_varint(len(name) - n_shared, buf)
+        buf += name[n_shared:]
 
-class PacketError(Exception):
-    pass
+        if len(fields) > 2:
+            pack_varint(size, buf)
+            mtime = round(mtime * 1e6)
+            delta = mtime - prev_mtime
+            pack_varint(delta * 2 if delta >= 0 else -delta * 2 - 1, buf)
+            buf += chksum
+            prev_mtime = mtime
+
+        prev_id, prev_name = entry_id, name
+        n_entries += 1
+
+    head = bytearray()
+    pack_varint(n_entries, head)
+    return bytes(head + buf)
+
+
+def unpack_manifest(body: Buffer) -> List[Tuple]:
+    '''批量解析目录、文件信息'''
+    entries: List[Tuple] = []
+    prev_id = prev_mtime = 0
+    prev_name = b''
+    dirs: Dict[int, bytes] = {}  # 本报文中出现过的目录: dir_id -> path
+    n_entries, offset = unpack_varint(body, 0)
+    for _ in range(n_entries):
+        kind = body[offset]
+        delta, offset = unpack_varint(body, offset + 1)
+        perm, offset = unpack_varint(body, offset)
+        parent_ref, offset = unpack_varint(body, offset)
+        n_shared, offset = unpack_varint(body, offset)
+        len_suffix, offset = unpack_varint(body, offset)
+        name = prev_name[:n_shared] + bytes(body[offset:offset + len_suffix])
+        offset += len_suffix
+
+        entry_id = prev_id + delta
+        path = dirs[parent_ref - 1] + b'/' + name if parent_ref else name
+        prev_id, prev_name = entry_id, name
+
+        if kind & ENTRY_FILE:
+            size, offset = unpack_varint(body, offset)
+            delta, offset = unpack_varint(body, offset)
+            prev_mtime += -((delta + 1) >> 1) if delta & 1 else delta >> 1
+            if kind & ENTRY_CHKSUM:
+                chksum = bytes(body[offset:offset + 16])
+                offset += 16
+            else:
+                chksum = b''
+            entries.append((entry_id, perm, size, prev_mtime / 1e6,
+                            chksum, path))
+        else:
+            dirs[entry_id] = path
+            entries.append((entry_id, perm, path))
+    return entries
+
+
+class Codec:
+    '''报文体编解码器
+
+    报文体由定长字段和一个可选的变长尾部组成。定长字段使用预编译的 Struct
+    编解码, 尾部的类型为:
+        - text:    UTF-8 字符串
+        - bytes:   短小的二进制数据, 解码时复制为 bytes
+        - payload: 大块数据, 编码时作为 Packet.payload 不做拷贝,
+                   解码时返回 body 的 memoryview 切片
+    '''
+
+    def __init__(self, fmt: str = '', tail: Optional[str] = None):
+        self.struct = Struct(f'>{fmt}')
+        self.tail = tail
+
+    def encode(self, *args) -> Tuple[bytes, Buffer]:
+        '''编码, 返回 (body, payload)'''
+        if self.tail is None:
+            return self.struct.pack(*args), b''
 
+        *fields, tail = args
+        head = self.struct.pack(*fields)
+        if self.tail == 'payload':
+            return head, tail
+        elif self.tail == 'text' and not isinstance(tail, bytes):
+            tail = str(tail).encode('utf8')
+        return head + tail, b''
+
+    def decode(self, body: Buffer) -> Tuple[Any, ...]:
+        fields = self.struct.unpack_from(body)
+        if self.tail is None:
+            return fields
+
+        tail = memoryview(body)[self.struct.size:]
+        if self.tail == 'text':
+            return fields + (str(tail, 'utf8'),)
+        elif self.tail == 'bytes':
+            return fields + (bytes(tail),)
+        else:
+            return fields + (tail,)
+
+
+class ArrayCodec(Codec):
+    '''由若干个相同结构的元素组成的报文体
+
+    元素只有一个字段时 (如 'I'), 直接编解码为整数序列; 否则每个元素为一个元组
+    '''
+
+    def __init__(self, fmt: str = 'I'):
+        super().__init__(fmt)
+        self.fmt = fmt
+
+    def encode(self, *args) -> Tuple[bytes, Buffer]:
+        if len(self.fmt) == 1:
+            return pack(f'>{len(args)}{self.fmt}', *args), b''
+        return b''.join(self.struct.pack(*item) for item in args), b''
+
+    def decode(self, body: Buffer) -> Tuple[Any, ...]:
+        if len(self.fmt) == 1:
+            n_items = len(body) // self.struct.size
+            return unpack(f'>{n_items}{self.fmt}', body)
+        return tuple(self.struct.iter_unpack(body))
+
+
+class ManifestCodec(Codec):
+    '''批量信息报文体'''
+
+    def encode(self, *args) -> Tuple[bytes, Buffer]:
+        return pack_manifest(args), b''
+
+    def decode(self, body: Buffer) -> Tuple[Any, ...]:
+        return tuple(unpack_manifest(body))
+
+
+CODECS: Dict[Flag, Codec] = {
+    Flag.PUSH: Codec(tail='text'),            # request (json)
+    Flag.PULL: Codec(tail='text'),            # request (json)
+    Flag.SID: Codec('16s', 'text'),           # session_id | params (json)
+    Flag.ATTACH: Codec('16s'),                # session_id
+    Flag.MONOFILE: Codec('?'),                # is monofile
+    Flag.DIR_INFO: Codec('IH', 'bytes'),      # dir_id | perm | path
+    Flag.FILE_INFO: Codec('IHQd16s', 'bytes'),  # file_id | perm | size | mtime | chksum | path
+    Flag.FILE_COUNT: Codec('I'),              # n_files
+    Flag.FILE_READY: ArrayCodec('I'),         # file_id ...
+    Flag.FILE_CHUNK: Codec('IQB', 'payload'),  # file_id | offset | codec | chunk
+    Flag.DONE: Codec('?'),                    # done
+    Flag.EXCEPTION: Codec(tail='text'),       # message
+    Flag.MANIFEST: ManifestCodec(),           # entries
+    Flag.CREDIT: Codec('Q'),                  # consumed (累计字节数)
+    Flag.ACK: ArrayCodec('IQ'),               # (file_id, offset) ...
+    Flag.CTRL_ACK: ArrayCodec('I'),           # seq ...
+    Flag.DETACH: Codec('B'),                  # stage
+}
+
+# 不编号的报文: 数据块按 (file_id, offset) 确认, 确认报文本身无需确认,
+# 终止报文发出后连接池随即关闭, 无从重发, DETACH 只属于所在的连接
+UNTRACKED = {Flag.FILE_CHUNK, Flag.ACK, Flag.CTRL_ACK, Flag.DONE,
+             Flag.EXCEPTION, Flag.DETACH}
+
+# 连接下线的三个阶段, 均在该连接上发出:
+#   0. 发起方停止在该连接上发送报文
+#   1. 对端读完发起方的报文, 同样停止发送
+#   2. 发起方读完对端的报文; 此后双方关闭连接, 其上的报文均已送达, 无需重发
+
+
+def sendmsg_all(sock: socket, buffers: List[Buffer]):
+    '''通过 sendmsg 分散写入多个缓冲区, 直至全部发送完毕'''
+    views = [memoryview(buf) for buf in buffers if len(buf)]
+    while views:
+        n_sent = sock.sendmsg(views)
+        while n_sent > 0:
+            if n_sent >= views[0].nbytes:
+                n_sent -= views.pop(0).nbytes
+            else:
+                views[0] = views[0][n_sent:]
+                n_sent = 0
 
-def send_pkt(conn: Connection, packet: Packet):
+
+def isendfile(sock_fd: int, payload: FileRange
+              ) -> Generator[Optional[bytes], None, None]:
+    '''通过 os.sendfile 将文件区间直接从页缓存写入 socket
+
+    socket 暂不可写时产出 None, 由调用方等待其可写后继续; 文件无法打开或被截短时
+    产出用于补足的 0, 由调用方发送。线程与事件循环各自以合适的方式等待和发送
+    '''
+    file_fd = payload.open()
+    if file_fd is None:
+        yield bytes(payload.length)
+        return
+
+    offset, remaining = payload.offset, payload.length
+    try:
+        while remaining > 0:
+            try:
+                n_sent = os.sendfile(sock_fd, file_fd, offset, remaining)
+            except BlockingIOError:
+                yield None
+                continue
+
+            if n_sent == 0:
+                # 文件被截短, 以 0 补足
+                yield bytes(remaining)
+                break
+            offset += n_sent
+            remaining -= n_sent
+    finally:
+        os.close(file_fd)
+
+
+def sendfile_all(sock: socket, payload: FileRange):
+    '''通过 os.sendfile 发送文件区间 (阻塞)'''
+    sock_fd = sock.fileno()
+    with closing(isendfile(sock_fd, payload)) as steps:
+        for zeros in steps:
+            if zeros is not None:
+                sock.sendall(zeros)
+                continue
+            # 设置了超时的 socket 实际是非阻塞的, 等待其可写
+            poller = poll()
+            poller.register(sock_fd, POLLOUT)
+            timeout = sock.gettimeout()
+            if not poller.poll(None if timeout is None else timeout * 1000):
+                raise TimeoutError('timed out')
+
+
+def send_pkt(conn: Connection, packet: Packet, algorithm='crc32'):
     '''发送数据报文'''
-    datagram = packet.pack()
-    conn.sendall(datagram)
+    if isinstance(conn, SSLSocket):
+        # SSLSocket 不支持 sendmsg, 报头与包体拼接后和数据块分两次写入
+        conn.sendall(packet.head(algorithm) + packet.body)
+        if packet.payload:
+            conn.sendall(packet.read_payload())
+    elif isinstance(conn, socket) and isinstance(packet.payload, FileRange):
+        sendmsg_all(conn, [packet.head(algorithm), packet.body])
+        sendfile_all(conn, packet.payload)
+    elif isinstance(conn, socket):
+        # 报头、包体、数据块直接交给内核, 不做拼接
+        head = packet.head(algorithm)
+        sendmsg_all(conn, [head, packet.body, packet.payload])
+    else:
+        # paramiko 的 Channel 只接受 bytes, 拼接为一个缓冲区后发送
+        conn.sendall(packet.pack(algorithm))
+
+
+class BufferPool:
+    '''可复用的接收缓冲区池
+
+    缓冲区按 2 的幂次分级, 小于 min_size 的报文直接分配, 不进入缓冲池。
+    取出的缓冲区用完后需调用 put 归还, 归还后不可再访问。
+    '''
+
+    def __init__(self, min_size=1024 * 64, max_bytes=1024 * 1024 * 64):
+        self.min_size = min_size
+        self.max_bytes = max_bytes  # 缓冲池最多保留的字节数
+        self.n_bytes = 0
+        self.mutex = Lock()
+        self.buffers: Dict[int, List[bytearray]] = {}
+
+    def get(self, size: int) -> memoryview:
+        '''取出一个长度为 size 的缓冲区'''
+        if size < self.min_size:
+            return memoryview(bytearray(size))
+
+        capacity = 1 << (size - 1).bit_length()
+        with self.mutex:
+            free = self.buffers.get(capacity)
+            if free:
+                buf = free.pop()
+                self.n_bytes -= capacity
+            else:
+                buf = bytearray(capacity)
+        return memoryview(buf)[:size]
+
+    def put(self, view: Buffer):
+        '''归还缓冲区'''
+        buf = view.obj if isinstance(view, memoryview) else view
+        if not isinstance(buf, bytearray):
+            return
 
+        capacity = len(buf)
+        if capacity < self.min_size or capacity & (capacity - 1):
+            return  # 非缓冲池分配的缓冲区
+
+        with self.mutex:
+            if self.n_bytes + capacity <= self.max_bytes:
+                self.buffers.setdefault(capacity, []).append(buf)
+                self.n_bytes += capacity
+
+
+def fingerprint(cert: bytes) -> str:
+    '''DER 格式证书的 SHA-256 指纹'''
+    return sha256(cert).hexdigest()
+
+
+def recv_into(conn: Connection, view: memoryview):
+    '''接收数据, 直至填满 view'''
+    while view:
+        if isinstance(conn, socket):
+            n_recv = conn.recv_into(view)
+        else:
+            # paramiko 的 Channel 不支持 recv_into
+            _data = conn.recv(len(view))
+            n_recv = len(_data)
+            view[:n_recv] = _data
 
-def recv_all(conn: Connection, length: int) -> bytes:
-    '''接受完整数据'''
-    datagram = bytearray()
-    while length > 0:
-        _data = conn.recv(length)
-        n_recv = len(_data)
         if n_recv > 0:
-            length -= n_recv
-            datagram += _data
+            view = view[n_recv:]
         else:
             raise ConnectionResetError
 
-    return bytes(datagram)
+
+# 数据块报文的定长字段: file_id | offset | codec
+CHUNK_HEAD = CODECS[Flag.FILE_CHUNK].struct
+
+# 数据块的落盘目标: 按 file_id 返回可直接写入的文件描述符 (由调用方关闭),
+# 文件不在写入中时返回 None
+Sink = Callable[[int], Optional[int]]
+
+
+def splice_target(sink: Sink, chunk_head: Buffer) -> Tuple[Optional[int], int]:
+    '''解析数据块的定长字段, 返回 (落盘的文件描述符, 写入的偏移量)
+
+    数据块经过压缩或文件不在写入中时, 文件描述符为 None, 数据块照常接收
+    '''
+    f_id, offset, codec = CHUNK_HEAD.unpack(chunk_head)
+    return (sink(f_id) if codec == CODEC_RAW else None), offset
+
+
+class Splicer:
+    '''经管道将 socket 中的数据用 os.splice 移入文件, 数据不进入用户空间'''
+    min_size = 1024 * 64  # 太小的数据块直接接收
+
+    def __init__(self, size=CHUNK_SIZE):
+        self.rfd, self.wfd = os.pipe()
+        try:
+            # 管道默认仅 64 KB, 尽量扩大以减少 splice 的调用次数
+            fcntl.fcntl(self.wfd, fcntl.F_SETPIPE_SZ, size)
+        except OSError:
+            pass  # 超过 /proc/sys/fs/pipe-max-size
+        self.size = fcntl.fcntl(self.wfd, fcntl.F_GETPIPE_SZ)
+
+    @classmethod
+    def wants(cls, flag: Flag, len_body: int) -> bool:
+        '''报文是否为足够大、值得拼接的数据块'''
+        return (flag == Flag.FILE_CHUNK
+                and len_body >= CHUNK_HEAD.size + cls.min_size)
+
+    @staticmethod
+    def usable(conn: Connection, algorithm: str) -> bool:
+        '''只有普通 socket 且无需校验和时才能拼接'''
+        return (hasattr(os, 'splice') and CHECKSUMS[algorithm] is None
+                and isinstance(conn, socket)
+                and not isinstance(conn, SSLSocket))
+
+    def fill(self, sock: socket, length: int) -> int:
+        '''从 socket 移入管道, 返回移入的字节数'''
+        n_bytes = os.splice(sock.fileno(), self.wfd, min(length, self.size))
+        if n_bytes == 0:
+            raise ConnectionResetError
+        return n_bytes
+
+    def drain(self, fd: int, offset: int, n_bytes: int):
+        '''将管道中的 n_bytes 字节写入文件的 offset 处'''
+        while n_bytes > 0:
+            n_written = os.splice(self.rfd, fd, n_bytes, offset_dst=offset)
+            offset += n_written
+            n_bytes -= n_written
+
+    def splice(self, sock: socket, fd: int, offset: int, length: int):
+        '''将 socket 中的 length 字节写入文件的 offset 处 (阻塞)'''
+        while length > 0:
+            try:
+                n_bytes = self.fill(sock, length)
+            except BlockingIOError:
+                # 设置了超时的 socket 实际是非阻塞的, 等待其可读
+                poller = poll()
+                poller.register(sock.fileno(), POLLIN)
+                timeout = sock.gettimeout()
+                if not poller.poll(None if timeout is None else timeout * 1000):
+                    raise TimeoutError('timed out')
+                continue
+            self.drain(fd, offset, n_bytes)
+            offset += n_bytes
+            length -= n_bytes
+
+    def close(self):
+        os.close(self.rfd)
+        os.close(self.wfd)
+
+
+class SplicerPool:
+    '''可复用的管道池
+
+    接收线程仅在拼接数据块时借用管道, 阻塞在 recv 上的线程不占用管道。
+    拼接失败的管道中可能残留数据, 不再归还。
+    '''
+
+    def __init__(self):
+        self.mutex = Lock()
+        self.idle: List[Splicer] = []
+        self.closed = False
+
+    def get(self) -> Splicer:
+        with self.mutex:
+            if self.idle:
+                return self.idle.pop()
+        return Splicer()
+
+    def put(self, splicer: Splicer):
+        with self.mutex:
+            if not self.closed:
+                self.idle.append(splicer)
+                return
+        splicer.close()
+
+    def close(self):
+        with self.mutex:
+            self.closed = True
+            idle, self.idle = self.idle, []
+        for splicer in idle:
+            splicer.close()
+
+
+class PacketReader:
+    '''从单个连接上逐个读取报文, 报头复用同一缓冲区, 包体取自缓冲池
+
+    指定 sink 和 splicers 时, 普通 socket 上未压缩的数据块经管道直接写入文件,
+    产出的报文以 FileRange 表示已写入的区间
+    '''
+
+    def __init__(self, conn: Connection, pool: Optional[BufferPool] = None,
+                 algorithm='crc32', sink: Optional[Sink] = None,
+                 splicers: Optional[SplicerPool] = None):
+        self.conn = conn
+        self.pool = pool or BufferPool(max_bytes=0)
+        self.verify = CHECKSUMS[algorithm]  # 为 None 时不校验
+        self.head = memoryview(bytearray(LEN_HEAD))
+        self.splicers = splicers
+        if splicers is not None and Splicer.usable(conn, algorithm):
+            self.sink = sink
+        else:
+            self.sink = None
+
+    def read(self) -> Packet:
+        # 接收并解析 head 部分
+        recv_into(self.conn, self.head)
+        flag, seq, chksum, len_body = Packet.unpack_head(self.head)
+
+        if self.sink is not None and Splicer.wants(flag, len_body):
+            return self.read_chunk(len_body)
+
+        # 接收 body 部分
+        body = self.pool.get(len_body)
+        recv_into(self.conn, body)
+        if self.verify is None or self.verify(body) == chksum:
+            return Packet(flag, body, chksum=chksum, seq=seq)
+        else:
+            self.pool.put(body)
+            raise PacketError('checksum mismatch')
+
+    def read_chunk(self, len_body: int) -> Packet:
+        '''先接收数据块的定长字段, 文件正在写入时将数据直接写入文件'''
+        chunk_head = bytearray(CHUNK_HEAD.size)
+        recv_into(self.conn, memoryview(chunk_head))
+        fd, offset = splice_target(self.sink, chunk_head)
+        length = len_body - CHUNK_HEAD.size
+        if fd is None:
+            body = self.pool.get(len_body)
+            body[:CHUNK_HEAD.size] = chunk_head
+            recv_into(self.conn, body[CHUNK_HEAD.size:])
+            return Packet(Flag.FILE_CHUNK, body, chksum=0)
+
+        splicer = self.splicers.get()
+        try:
+            splicer.splice(self.conn, fd, offset, length)
+        except BaseException:
+            splicer.close()
+            raise
+        else:
+            self.splicers.put(splicer)
+        finally:
+            os.close(fd)
+        return Packet(Flag.FILE_CHUNK, chunk_head,
+                      FileRange(None, offset, length), chksum=0)
 
 
 def recv_pkt(conn: Connection) -> Packet:
     '''接收数据报文'''
-    # 接收并解析 head 部分
-    head = recv_all(conn, LEN_HEAD)
-    flag, chksum, len_body = Packet.unpack_head(head)
-
-    # 接收 body 部分
-    body = recv_all(conn, len_body)
-    if crc32(body) == chksum:
-        return Packet(flag, body)
-    else:
-        raise PacketError
+    return PacketReader(conn).read()
+
+
+# 发送通道: 数值越小越优先, 控制报文总是先于排队中的数据块发出
+LANE_CONTROL = 0
+LANE_DATA = 1
+LANE_NAMES = ('control', 'data')
+
+
+def lane_of(packet: Packet) -> int:
+    return LANE_DATA if packet.flag == Flag.FILE_CHUNK else LANE_CONTROL
+
+
+class LaneStats:
+    '''发送通道的排队时延统计'''
+    __slots__ = ('name', 'n_packets', 'total_wait', 'max_wait', 'mutex')
+
+    def __init__(self, name: str):
+        self.name = name
+        self.n_packets = 0
+        self.total_wait = 0.0  # 累计排队时间 (秒)
+        self.max_wait = 0.0
+        self.mutex = Lock()
+
+    def __str__(self) -> str:
+        avg = self.total_wait / self.n_packets if self.n_packets else 0.0
+        return (f'Lane({self.name}: n={self.n_packets}, '
+                f'avg_wait={avg * 1000:.2f}ms, '
+                f'max_wait={self.max_wait * 1000:.2f}ms)')
+
+    def record(self, t_put: float):
+        '''报文出队, t_put 为其入队时间'''
+        wait = monotonic() - t_put
+        with self.mutex:
+            self.n_packets += 1
+            self.total_wait += wait
+            if wait > self.max_wait:
+                self.max_wait = wait
 
 
-class Counter:
+class RecvQueue:
+    '''接收队列: 控制报文先于排队中的数据块交给上层处理, 并统计各通道的排队时延'''
+
     def __init__(self):
-        self.n_sent = 0
+        self.queue: PriorityQueue = PriorityQueue()
+        self.seq = count()
+        self.lanes = [LaneStats(name) for name in LANE_NAMES]
+
+    def put(self, packet: Packet):
+        lane = lane_of(packet)
+        self.queue.put((lane, next(self.seq), monotonic(), packet))
+
+    def get(self, block=True, timeout=None) -> Optional[Packet]:
+        lane, _, t_put, packet = self.queue.get(block, timeout)
+        if packet is not None:
+            self.lanes[lane].record(t_put)
+        return packet
+
+    def wake(self):
+        '''放入一个 None, 唤醒阻塞在 get 上的线程'''
+        self.queue.put((LANE_CONTROL, next(self.seq), monotonic(), None))
+
+
+class FlowControl:
+    '''基于额度的流量控制
+
+    发送端发出数据块报文前须等待额度, 额度不足时阻塞, 反压由此一直传递到
+    文件读取; 接收端处理完数据块报文后累计其长度, 比上次归还时多出窗口的
+    1/4 时以 CREDIT 报文告知累计总量, 发送端的额度为
+    window - (已发出总量 - 已处理总量)。CREDIT 携带的是总量而非增量, 丢失
+    一个会由下一个弥补, 重复收到也不会多算。已发出但未处理的数据块因此不会
+    超过 credit_window, 接收端磁盘较慢时内存占用也是有界的。控制类报文不受
+    额度限制。
+    '''
+
+    def __init__(self, window: int):
+        self.window = window
+        self.sent = 0  # 发送端: 已发出的数据块字节数 (重发的不计)
+        self.consumed = 0  # 接收端已处理的数据块字节数 (发送端为已知的最大值)
+        self.returned = 0  # 接收端: 上次归还时的 consumed
+        self.cond = Condition()
+
+    def acquire(self, packet: Packet):
+        '''发送端: 等待额度, 不足时阻塞'''
+        if packet.flag != Flag.FILE_CHUNK:
+            return
+        with self.cond:
+            while self.sent - self.consumed + packet.length > self.window:
+                self.cond.wait()
+            self.sent += packet.length
+
+    def grant(self, consumed: int):
+        '''发送端: 收到接收端已处理的总量'''
+        with self.cond:
+            if consumed > self.consumed:
+                self.consumed = consumed
+                self.cond.notify_all()
+
+    def consume(self, packet: Packet) -> int:
+        '''接收端: 处理完一个报文, 返回此时应告知的总量 (0 为暂不归还)'''
+        if packet.flag != Flag.FILE_CHUNK:
+            return 0
+        with self.cond:
+            self.consumed += packet.length
+            if self.consumed - self.returned < self.window // 4:
+                return 0
+            self.returned = self.consumed
+            return self.consumed
 
-    def acc(self, length):
-        self.n_sent += length
 
+class Inflight:
+    '''已发出但尚未确认的报文
 
-class ConnectionPool(Thread):
+    发送端按 (file_id, offset) 记录每个数据块报文、按 seq 记录每个控制报文,
+    连同发送它的连接, 收到 ACK / CTRL_ACK 后移除; 连接断开时, 其上未确认的
+    报文交由其他连接重发。接收端收到控制报文即以 CTRL_ACK 确认, 并按 seq
+    去重。接收端记录处理完的
+    数据块, 随 CREDIT 一起以 ACK 报文确认; 重发的数据块可能重复到达, 只有
+    首次到达的交给上层并计入额度, 重复的直接确认。未确认的数据块受
+    credit_window 限制, 保留它们所占的内存也是有界的。
+    '''
+
+    def __init__(self):
+        self.mutex = Lock()
+        # 键为数据块的 (file_id, offset) 或控制报文的 seq
+        self.packets: Dict[Union[int, Tuple[int, int]],
+                           Tuple[Connection, Packet]] = {}
+        self.acks: List[Tuple[int, int]] = []  # 接收端待确认的数据块
+        # 接收端: 正在接收的文件已到达的数据块偏移量, 文件接收完毕后移除
+        self.arrived: Dict[int, Set[int]] = {}
+        # 接收端: 已到达的控制报文, 不大于 seq_floor 的均已到达
+        self.seq_floor = 0
+        self.seqs: Set[int] = set()
+
+    @staticmethod
+    def key(packet: Packet) -> Tuple[int, int]:
+        return CODECS[Flag.FILE_CHUNK].struct.unpack_from(packet.body)[:2]
+
+    def sent(self, conn: Connection, packet: Packet):
+        '''发送端: 报文即将通过 conn 发出'''
+        if packet.flag == Flag.FILE_CHUNK:
+            with self.mutex:
+                self.packets[self.key(packet)] = (conn, packet)
+        elif packet.seq:
+            with self.mutex:
+                self.packets[packet.seq] = (conn, packet)
+
+    def ack(self, keys: Iterable[Union[int, Tuple[int, int]]]):
+        '''发送端: 收到对端的确认'''
+        with self.mutex:
+            for key in keys:
+                self.packets.pop(key, None)
+
+    def lost(self, conn: Connection) -> List[Packet]:
+        '''发送端: 连接断开, 取出其上所有未确认的报文'''
+        with self.mutex:
+            keys = [k for k, (c, _) in self.packets.items() if c is conn]
+            return [self.packets.pop(k)[1] for k in keys]
+
+    def arrive(self, packet: Packet) -> bool:
+        '''接收端: 数据块到达, 是首次到达时返回 True, 重复的直接待确认
+
+        不在接收中的文件 (已接收完毕) 的数据块均为重复
+        '''
+        f_id, offset = key = self.key(packet)
+        with self.mutex:
+            offsets = self.arrived.get(f_id)
+            if offsets is not None and offset not in offsets:
+                offsets.add(offset)
+                return True
+            self.acks.append(key)
+            return False
+
+    def expect(self, f_id: int):
+        '''接收端: 文件开始接收, 须先于通知对端发送'''
+        with self.mutex:
+            self.arrived[f_id] = set()
+
+    def finish(self, f_id: int):
+        '''接收端: 文件已接收完毕 (或已放弃), 此后到达的数据块均为重复'''
+        with self.mutex:
+            self.arrived.pop(f_id, None)
+
+    def accept(self, seq: int) -> bool:
+        '''接收端: 控制报文到达, 是首次到达时返回 True'''
+        with self.mutex:
+            if seq <= self.seq_floor or seq in self.seqs:
+                return False
+            self.seqs.add(seq)
+            while self.seq_floor + 1 in self.seqs:
+                self.seq_floor += 1
+                self.seqs.remove(self.seq_floor)
+            return True
+
+    def received(self, packet: Packet):
+        '''接收端: 数据块报文已处理完毕'''
+        if packet.flag == Flag.FILE_CHUNK:
+            with self.mutex:
+                self.acks.append(self.key(packet))
+
+    def take_acks(self) -> List[Tuple[int, int]]:
+        '''接收端: 取出所有待确认的数据块'''
+        with self.mutex:
+            acks, self.acks = self.acks, []
+            return acks
+
+    def clear(self):
+        '''连接池关闭: 丢弃未确认的报文, 释放数据块引用的文件'''
+        with self.mutex:
+            self.packets.clear()
+            self.acks.clear()
+            self.arrived.clear()
+
+
+class BaseConnectionPool(Thread):
+    '''连接池的公共部分
+
+    报文的编号、流量控制、确认与去重、接收队列、连接的调优与统计均与 I/O 方式
+    无关, 由两种实现共用; 子类只负责驱动各连接上的收发。
+    发送队列分为控制、数据两条通道, 各自限制容量, 控制报文优先发出。
+    '''
     _max_size = 128
+    _detach_timeout = 10  # 排空连接的最长等待时间 (秒)
 
-    def __init__(self, size=16):
+    def __init__(self, session: Session):
         super().__init__(daemon=True)
-        self.size = min(size, self._max_size)
-        self.send_q = Queue(self.size)
-        self.recv_q = Queue()
-        self.done = Event()
-        self.sender = SelectSelector()
+        self.session = session
+        self.size = min(session.max_channels, self._max_size)
+        self.algorithm = session.chksum  # 报文校验算法
+        self.lane_slots = [Semaphore(self.size) for _ in LANE_NAMES]
+        self.lanes = [LaneStats(name) for name in LANE_NAMES]
+        self.seq = count()
+        self.recv_q = RecvQueue()
+        self.buffers = BufferPool()  # 接收缓冲区
+        self.flow = FlowControl(session.credit_window)  # 数据块流量控制
+        self.inflight = Inflight()  # 未确认的报文
+        self.ctrl_seq = count(1)  # 控制报文编号
+        self.traffic = 0  # 已收发的字节数, 用于估算吞吐量
+        self.tunings: Dict[Connection, SocketTuning] = {}  # 各连接的调优结果
+        self.sink: Optional[Sink] = None  # 数据块的落盘目标, 须在添加连接前设置
+        self.done = Event()  # 连接池已停止, 不再发送和重发
+        self.ended = Event()  # 会话已结束: 终止报文 (DONE、EXCEPTION) 已发出或收到
+        self.mutex = Lock()
         self.connections: Set[Connection] = set()
+        self.draining: Dict[Connection, Event] = {}  # 下线中的连接及其关闭事件
 
     def send(self, packet: Packet):
-        self.send_q.put(packet)
+        self.flow.acquire(packet)
+        if packet.flag not in UNTRACKED:
+            packet.seq = next(self.ctrl_seq)
+        lane = lane_of(packet)
+        self.lane_slots[lane].acquire()
+        self._submit(lane, packet)
 
-    def recv(self, timeout=TIMEOUT) -> Packet:
+    def _submit(self, lane: int, packet: Packet):
+        '''将已占用通道容量的报文放入发送队列 (可在任意线程中调用)'''
+        raise NotImplementedError
+
+    def _reply(self, packet: Packet):
+        '''将不占用通道容量的报文 (确认、重发) 放入发送队列, 避免接收方阻塞'''
+        raise NotImplementedError
+
+    @property
+    def ending(self) -> bool:
+        '''连接池已停止或会话已结束, 此时对端关闭连接属正常结束, 不必告警和重发'''
+        return self.done.is_set() or self.ended.is_set()
+
+    def recv(self, timeout=TIMEOUT) -> Optional[Packet]:
+        '''取出一个报文, 被 wake 唤醒时返回 None'''
         return self.recv_q.get(timeout)
 
-    def add(self, conn: Connection):
-        '''添加一个连接'''
-        # 检查数量是否达到上限
-        if len(self.connections) >= self._max_size:
-            return False
-        # 检查是否已添加过
-        if conn in self.connections:
-            return True
+    def wake(self):
+        '''唤醒阻塞在 recv 上的线程 (可在任意线程中调用)'''
+        self.recv_q.wake()
+
+    def release(self, packet: Packet):
+        '''报文处理完毕后, 归还其接收缓冲区, 并按需向对端确认数据块、归还额度'''
+        self.inflight.received(packet)
+        self.buffers.put(packet.body)
+        consumed = self.flow.consume(packet)
+        if consumed:
+            self.send(Packet.load(Flag.ACK, *self.inflight.take_acks()))
+            self.send(Packet.load(Flag.CREDIT, consumed))
+
+    def expect(self, f_id: int):
+        '''文件开始接收, 此后其数据块交给上层 (须先于通知对端发送)'''
+        self.inflight.expect(f_id)
+
+    def finish(self, f_id: int):
+        '''文件已接收完毕, 此后重复到达的数据块不再交给上层'''
+        self.inflight.finish(f_id)
+
+    def add(self, conn: Connection) -> bool:
+        '''添加一个连接 (可在任意线程中调用)'''
+        with self.mutex:
+            # 检查数量是否达到会话协商的上限
+            if len(self.connections) >= self.size:
+                return False
+            # 检查是否已添加过
+            if conn in self.connections:
+                return True
+            self.connections.add(conn)
+        self.tune(conn)
+        return self._attach(conn)
 
-        self.connections.add(conn)
-        self.sender.register(conn, EVENT_WRITE, data=Counter())
+    def _attach(self, conn: Connection) -> bool:
+        '''开始在连接上收发报文, 返回是否成功'''
+        raise NotImplementedError
 
-        t_recv = Thread(target=self.listen_to_recv, args=(conn,), daemon=True)
-        t_recv.start()
+    def tune(self, conn: Connection):
+        '''按会话参数调优 TCP 连接 (Channel 由 SSH 隧道承载, 无需调优)'''
+        if isinstance(conn, socket):
+            self.tunings[conn] = tune_socket(conn, self.session.sock_buf,
+                                             self.session.congestion,
+                                             self.session.chunk_size)
+
+    def resend(self, packets: List[Packet]):
+        '''重发报文 (这些报文已扣除过额度), 会话已结束或已没有连接时
+        无需或无从发出, 直接丢弃'''
+        if self.ending or not self.connections:
+            return
+        if packets:
+            logging.warning(f'[Send] resend {len(packets)} packets')
+        for packet in packets:
+            self._reply(packet)
+
+    def dispatch(self, packet: Packet):
+        '''处理收到的报文: 确认控制报文, 连接池自用的直接处理, 重复的丢弃,
+        其余交给上层'''
+        if packet.seq:
+            self._reply(Packet.load(Flag.CTRL_ACK, packet.seq))
+        if packet.flag in (Flag.DONE, Flag.EXCEPTION):
+            self.ended.set()
+
+        if packet.seq and not self.inflight.accept(packet.seq):
+            self.buffers.put(packet.body)  # 重复的控制报文
+        elif packet.flag == Flag.CREDIT:
+            self.flow.grant(*packet.unpack_body())
+        elif packet.flag in (Flag.ACK, Flag.CTRL_ACK):
+            self.inflight.ack(packet.unpack_body())
+        elif (packet.flag == Flag.FILE_CHUNK
+              and not self.inflight.arrive(packet)):
+            self.buffers.put(packet.body)  # 重复的数据块
+        else:
+            self.recv_q.put(packet)
+
+    def _sent_out(self, packet: Packet):
+        '''报文已在连接上发出'''
+        self.traffic += packet.length
+        if packet.flag in (Flag.DONE, Flag.EXCEPTION):
+            self.ended.set()
+
+    def log_stats(self):
+        '''连接池停止时输出各通道的排队时间与连接的调优结果'''
+        for stats in self.lanes:
+            logging.debug(f'[Send] {stats}')
+        for stats in self.recv_q.lanes:
+            logging.debug(f'[Recv] {stats}')
+        for tuning, n in Counter(map(str, self.tunings.values())).items():
+            logging.debug(f'[Socket] {n} x {tuning}')
+
+
+class ConnectionPool(BaseConnectionPool):
+    '''基于线程的连接池
+
+    每个连接各有一个接收线程和一个发送线程, 发送线程从共享的发送队列中
+    取报文, 空闲的连接取走下一个报文, 慢速连接不会阻塞其他连接。
+    取报文前须经调度器同意, 调度器可让慢速连接让位给更快的连接。
+    主动移除的连接先经 DETACH 排空, 双方读完对方的报文后才关闭。
+    '''
+
+    def __init__(self, session: Session, scheduler='throughput'):
+        super().__init__(session)
+        # 元素为 (通道, 序号, 入队时间, 报文, 是否占用通道容量)
+        self.send_q: PriorityQueue = PriorityQueue()
+        self.splicers = SplicerPool()  # 拼接数据块的管道
+        self.scheduler: Scheduler = SCHEDULERS[scheduler]()
+        self.writing: Dict[Connection, Lock] = {}  # 各连接的写入锁
+        self.n_senders = 0  # 存活的发送线程数
+
+    def _submit(self, lane: int, packet: Packet):
+        self._enqueue(lane, packet, True)
+
+    def _reply(self, packet: Packet):
+        self._enqueue(lane_of(packet), packet, False)
+
+    def _enqueue(self, lane: int, packet: Optional[Packet], has_slot: bool):
+        self.send_q.put((lane, next(self.seq), monotonic(), packet, has_slot))
+
+    def _attach(self, conn: Connection) -> bool:
+        with self.mutex:
+            self.writing[conn] = writing = Lock()
+            self.n_senders += 1
+        self.scheduler.add(conn)
+
+        Thread(target=self.listen_to_send, args=(conn, writing),
+               daemon=True).start()
+        Thread(target=self.listen_to_recv, args=(conn,), daemon=True).start()
         return True
 
-    def pop(self, conn: Connection):
-        try:
-            self.sender.unregister(conn)
-        except (KeyError, ValueError):
-            pass
+    def remove(self, conn: Connection):
+        '''主动移除一个连接, 排空后返回 (可在任意线程中调用)'''
+        closed = self.detach(conn, 0)
+        if not closed.wait(self._detach_timeout):
+            logging.warning(f'[Send] Conn-{id(conn):x}: detach timeout.')
+            self.pop(conn)
 
-        try:
-            self.connections.remove(conn)
-        except KeyError:
-            pass
-        finally:
+    def detach(self, conn: Connection, stage: int) -> Event:
+        '''停止在连接上发送报文, 并在其上发出 DETACH, 返回连接的关闭事件'''
+        with self.mutex:
+            writing = self.writing.get(conn)
+            self.connections.discard(conn)
+            if writing is None or self.done.is_set():
+                # 未加入连接池、已关闭, 或连接池已停止
+                closed = self.draining.pop(conn, None) or Event()
+                writing = None
+            else:
+                closed = self.draining.setdefault(conn, Event())
+        if writing is None:
             conn.close()
+            closed.set()
+            return closed
 
-    def listen_to_send(self):
-        while not self.done.is_set():
-            # find the conn that sent the least data
-            keys = [key for key, _ in self.sender.select(timeout=1)]
-            if not keys:
-                continue
-            else:
-                key = min(keys, key=lambda k: k.data.n_sent)
+        self.scheduler.remove(conn)
+        try:
+            # 等待发送线程发完当前报文, 此后它不再使用该连接
+            with writing:
+                send_pkt(conn, Packet.load(Flag.DETACH, stage), self.algorithm)
+        except SocketError as e:
+            logging.warning(f'[Send] Conn-{id(conn):x}: {e}.')
+            self.pop(conn)
+        return closed
+
+    def detached(self, conn: Connection):
+        '''连接已排空: 双方均已读完对方的报文, 直接关闭'''
+        with self.mutex:
+            self.writing.pop(conn, None)
+            closed = self.draining.pop(conn, None)
+        conn.close()
+        self.inflight.lost(conn)  # 均已送达, 无需重发
+        if closed is not None:
+            closed.set()
 
-            # get data
+    def pop(self, conn: Connection):
+        with self.mutex:
+            self.connections.discard(conn)
+            self.writing.pop(conn, None)
+            closed = self.draining.pop(conn, None)
+        self.scheduler.remove(conn)
+        conn.close()
+        # 该连接上未确认的报文交由其他连接重发
+        if not self.done.is_set():
+            self.resend(self.inflight.lost(conn))
+            if not self.connections:
+                self.drop_queued()
+        if closed is not None:
+            closed.set()
+
+    def drop_queued(self):
+        '''所有连接均已断开 (如对端结束会话): 丢弃排队的报文,
+        以免 stop 一直等待它们发出'''
+        while True:
             try:
-                packet: Packet = self.send_q.get(timeout=TIMEOUT)
-                conn: Connection = key.fileobj
+                lane, _, _, packet, has_slot = self.send_q.get_nowait()
             except Empty:
-                break
+                return
+            if packet is not None and has_slot:
+                self.lane_slots[lane].release()
+            self.send_q.task_done()
 
-            # send
-            try:
-                send_pkt(conn, packet)
-                key.data.acc(packet.length)
-            except SocketError as e:
-                self.pop(conn)
+    def listen_to_send(self, conn: Connection, writing: Lock):
+        '''从共享队列中取出报文, 通过本连接发送'''
+        try:
+            while conn in self.connections:
+                self.scheduler.acquire(conn, self.send_q.qsize)
+                if not self._send_one(conn, writing):
+                    return
+        finally:
+            with self.mutex:
+                self.n_senders -= 1
+
+    def _send_one(self, conn: Connection, writing: Lock) -> bool:
+        '''取出一个报文发送, 返回本连接能否继续发送'''
+        lane, _, t_put, packet, has_slot = self.send_q.get()
+        try:
+            if packet is None or self.done.is_set():
+                return False  # 连接池已停止
+            with writing:
+                if conn not in self.connections:
+                    # 连接已下线或关闭, 报文交由其他连接发送
+                    if self.connections:
+                        self._enqueue(lane, packet, has_slot)
+                    elif has_slot:
+                        self.lane_slots[lane].release()
+                    return False
+                if has_slot:
+                    self.lane_slots[lane].release()
+                self.lanes[lane].record(t_put)
+                self.inflight.sent(conn, packet)
+                self.scheduler.start(conn)
+                send_pkt(conn, packet, self.algorithm)
+            self.scheduler.finish(conn, packet.length)
+            self._sent_out(packet)
+            return True
+        except SocketError as e:
+            if not self.ending:
                 logging.warning(f'[Send] Conn-{id(conn):x}: {e}.')
+            self.pop(conn)
+            # 已记录的报文随 pop 重发, 不编号的报文在此重发
+            if packet.flag != Flag.FILE_CHUNK and not packet.seq:
+                self.resend([packet])
+            return False
+        finally:
+            self.send_q.task_done()
 
     def listen_to_recv(self, conn: Connection):
         conn_name = f'{id(conn):x}'
+        reader = PacketReader(conn, self.buffers, self.algorithm, self.sink,
+                              self.splicers)
         while not self.done.is_set():
             try:
-                packet = recv_pkt(conn)
-                self.recv_q.put(packet)
+                packet = reader.read()
+                self.traffic += packet.length
+                if packet.flag == Flag.DETACH:
+                    stage, = packet.unpack_body()
+                    self.buffers.put(packet.body)
+                    if stage == 0:
+                        self.detach(conn, 1)  # 对端下线该连接, 回应后继续读
+                        continue
+                    elif stage == 1:
+                        self.detach(conn, 2)
+                    self.detached(conn)
+                    return
+                self.dispatch(packet)
                 logging.debug(f'[Recv] conn-{conn_name}: {packet}')
             except ConnectionResetError:
                 self.pop(conn)
                 return
             except SocketError as e:
                 self.pop(conn)
-                logging.warning(f'[Recv] Conn-{conn_name}: {e}.')
-            except PacketError:
+                if not self.ending:  # 会话结束时对端关闭连接, 不必告警
+                    logging.warning(f'[Recv] Conn-{conn_name}: {e}.')
+                return
+            except PacketError as e:
                 self.pop(conn)
-                logging.error(f'conn-{conn_name} received an error packet.')
+                logging.error(f'conn-{conn_name} received an error packet: {e}')
                 return
 
     def stop(self):
-        while not self.send_q.empty():
-            sleep(0.2)
+        # 等待已提交的报文发送完毕
+        self.send_q.join()
         self.done.set()
-        self.sender.close()
-        for conn in self.connections.copy():
+        with self.mutex:
+            connections = list(self.connections) + list(self.draining)
+            n_senders = self.n_senders
+        # 唤醒所有发送线程, 使其退出 (包括在调度器中让位等待的线程)
+        for conn in connections:
+            self.scheduler.remove(conn)
+        for _ in range(n_senders):
+            self._enqueue(LANE_CONTROL, None, False)
+        for conn in connections:
             conn.close()
+        for closed in list(self.draining.values()):
+            closed.set()
+        self.inflight.clear()
+        self.splicers.close()
+        self.log_stats()
 
     def run(self):
         if not self.connections:
             raise ValueError('No connection')
 
         self.done.clear()
-        self.listen_to_send()
-        self.stop()
+        self.done.wait()
+
+
+class AsyncConnectionPool(BaseConnectionPool):
+    '''基于 asyncio 的连接池
+
+    一个会话的所有连接由同一个事件循环驱动, 只占用一个线程, 不轮询。
+    socket 以非阻塞方式收发 (SSLSocket 自行等待底层 socket 就绪); paramiko 的 Channel 通过 fileno() 管道获得
+    可读事件, 而其写入是阻塞的, 交给一个小线程池完成。
+    对外的 add / send / recv / release / start / stop 与 ConnectionPool 一致。
+    '''
+    n_writers = 4  # Channel 写入线程数
+
+    def __init__(self, session: Session):
+        super().__init__(session)
+        self.verify = CHECKSUMS[self.algorithm]
+        self.loop = asyncio.new_event_loop()
+        # 元素为 (通道, 序号, 入队时间, 报文, 是否占用通道容量), 在事件循环内创建
+        self.send_q: Optional[asyncio.PriorityQueue] = None
+        self.executor: Optional[ThreadPoolExecutor] = None
+        self.n_pending = 0  # 尚未发出的报文数
+        self.flushed = Event()  # 所有报文均已发出
+        self.flushed.set()
+        self.tasks: Dict[Connection, List[asyncio.Task]] = {}
+        self.idle: Set[Connection] = set()  # 发送协程正在等待报文的连接
+
+    def _submit(self, lane: int, packet: Packet):
+        self._pending()
+        self.loop.call_soon_threadsafe(self._enqueue, packet, True)
+
+    def _pending(self):
+        '''一个报文进入发送队列'''
+        with self.mutex:
+            self.n_pending += 1
+            self.flushed.clear()
+
+    def _attach(self, conn: Connection) -> bool:
+        try:
+            self.loop.call_soon_threadsafe(self._create_tasks, conn)
+        except RuntimeError:
+            # 事件循环已关闭
+            with self.mutex:
+                self.connections.discard(conn)
+            return False
+        return True
+
+    def remove(self, conn: Connection):
+        '''主动移除一个连接, 排空后返回 (可在任意线程中调用)'''
+        closed = Event()
+        try:
+            self.loop.call_soon_threadsafe(self._remove, conn, closed)
+        except RuntimeError:
+            conn.close()  # 事件循环已关闭
+            return
+        if not closed.wait(self._detach_timeout):
+            logging.warning(f'[Send] Conn-{id(conn):x}: detach timeout.')
+            try:
+                self.loop.call_soon_threadsafe(self.pop, conn)
+            except RuntimeError:
+                pass
+
+    def _remove(self, conn: Connection, closed: Event):
+        '''开始排空连接 (仅在事件循环中调用)'''
+        if conn not in self.tasks:
+            # 未加入连接池或已关闭
+            conn.close()
+            closed.set()
+            return
+        self.draining[conn] = closed
+        self.tasks[conn].append(self.loop.create_task(self.detach(conn, 0)))
+
+    async def detach(self, conn: Connection, stage: int):
+        '''停止在连接上发送报文, 并在其上发出 DETACH'''
+        self.draining.setdefault(conn, Event())
+        with self.mutex:
+            self.connections.discard(conn)
+        # 等待发送协程发完当前报文后退出
+        sender = self.tasks[conn][0]
+        if conn in self.idle:
+            sender.cancel()
+        await asyncio.wait([sender])
+        if conn not in self.tasks:
+            return  # 连接已断开
+        try:
+            await self._send_pkt(conn, Packet.load(Flag.DETACH, stage))
+        except SocketError as e:
+            logging.warning(f'[Send] Conn-{id(conn):x}: {e}.')
+            self.pop(conn)
+
+    def detached(self, conn: Connection):
+        '''连接已排空: 双方均已读完对方的报文, 直接关闭 (仅在事件循环中调用)'''
+        self.inflight.lost(conn)  # 均已送达, 无需重发
+        self.pop(conn)
+
+    def pop(self, conn: Connection):
+        '''移除连接 (仅在事件循环中调用)'''
+        current = asyncio.current_task(self.loop)
+        tasks = [t for t in self.tasks.pop(conn, []) if t is not current]
+        for task in tasks:
+            task.cancel()
+
+        with self.mutex:
+            self.connections.discard(conn)
+        if tasks and not self.done.is_set():
+            # 被取消的协程退出后再关闭, 以免其收尾时操作已关闭的 socket
+            waiter = asyncio.gather(*tasks, return_exceptions=True)
+            waiter.add_done_callback(lambda _: conn.close())
+        else:
+            conn.close()
+        # 该连接上未确认的报文交由其他连接重发
+        self.resend(self.inflight.lost(conn))
+        if not self.connections and not self.done.is_set():
+            self.drop_queued()
+        closed = self.draining.pop(conn, None)
+        if closed is not None:
+            closed.set()
+
+    def drop_queued(self):
+        '''所有连接均已断开 (如对端结束会话): 丢弃排队的报文,
+        以免 stop 一直等待它们发出 (仅在事件循环中调用)'''
+        while not self.send_q.empty():
+            lane, _, _, _, has_slot = self.send_q.get_nowait()
+            self._sent(lane, has_slot)
+
+    def _reply(self, packet: Packet):
+        '''将确认、重发的报文放入发送队列 (仅在事件循环中调用)'''
+        if self.done.is_set():
+            return
+        self._pending()
+        self._enqueue(packet, False)
+
+    def _enqueue(self, packet: Packet, has_slot: bool):
+        item = (lane_of(packet), next(self.seq), monotonic(), packet, has_slot)
+        self.send_q.put_nowait(item)
+
+    def _sent(self, lane: int, has_slot: bool):
+        '''一个报文处理完毕 (发出或随连接丢弃)'''
+        if has_slot:
+            self.lane_slots[lane].release()
+        with self.mutex:
+            self.n_pending -= 1
+            if self.n_pending == 0:
+                self.flushed.set()
+
+    def _create_tasks(self, conn: Connection):
+        '''为连接创建收发协程'''
+        if isinstance(conn, socket):
+            conn.setblocking(False)
+        self.tasks[conn] = [self.loop.create_task(self.listen_to_send(conn)),
+                            self.loop.create_task(self.listen_to_recv(conn))]
+
+    async def _wait_ready(self, fd: int, writable=False):
+        '''等待文件描述符可读 (或可写)'''
+        ready = self.loop.create_future()
+
+        def callback():
+            if not ready.done():
+                ready.set_result(None)
+
+        if writable:
+            self.loop.add_writer(fd, callback)
+        else:
+            self.loop.add_reader(fd, callback)
+        try:
+            await ready
+        finally:
+            if writable:
+                self.loop.remove_writer(fd)
+            else:
+                self.loop.remove_reader(fd)
+
+    async def _ssl_call(self, conn: SSLSocket, func: Callable[[Buffer], int],
+                        view: Buffer) -> int:
+        '''在非阻塞的 SSLSocket 上调用 recv_into / send
+
+        loop.sock_* 不接受 SSLSocket; TLS 需要读写底层 socket 时等待其就绪,
+        之后以同一缓冲区重试
+        '''
+        while True:
+            try:
+                return func(view)
+            except SSLWantReadError:
+                await self._wait_ready(conn.fileno())
+            except SSLWantWriteError:
+                await self._wait_ready(conn.fileno(), writable=True)
+
+    async def _recv_into(self, conn: Connection, view: memoryview):
+        '''接收数据, 直至填满 view'''
+        while view:
+            if isinstance(conn, SSLSocket):
+                n_recv = await self._ssl_call(conn, conn.recv_into, view)
+            elif isinstance(conn, socket):
+                n_recv = await self.loop.sock_recv_into(conn, view)
+            else:
+                # 管道可读时 Channel 中已有数据 (或已关闭), recv 不会阻塞
+                while not (conn.recv_ready() or conn.eof_received
+                           or conn.closed):
+                    await self._wait_ready(conn.fileno())
+                _data = conn.recv(len(view))
+                n_recv = len(_data)
+                view[:n_recv] = _data
+
+            if n_recv > 0:
+                view = view[n_recv:]
+            else:
+                raise ConnectionResetError
+
+    async def _sendfile(self, conn: socket, payload: FileRange):
+        '''通过 os.sendfile 发送文件区间 (loop.sock_sendfile 会移动共享的文件
+        读写位置, 且不可用时退回 seek + read, 不适用于多个连接并发发送同一文件)
+        '''
+        sock_fd = conn.fileno()
+        with closing(isendfile(sock_fd, payload)) as steps:
+            for zeros in steps:
+                if zeros is None:
+                    await self._wait_ready(sock_fd, writable=True)
+                else:
+                    await self.loop.sock_sendall(conn, zeros)
+
+    async def _send_pkt(self, conn: Connection, packet: Packet):
+        if isinstance(conn, SSLSocket):
+            for data in (packet.head(self.algorithm) + packet.body,
+                         packet.read_payload()):
+                view = memoryview(data)
+                while view:
+                    view = view[await self._ssl_call(conn, conn.send, view):]
+        elif isinstance(conn, socket):
+            head = packet.head(self.algorithm)
+            await self.loop.sock_sendall(conn, head + packet.body)
+            if isinstance(packet.payload, FileRange):
+                await self._sendfile(conn, packet.payload)
+            elif packet.payload:
+                await self.loop.sock_sendall(conn, packet.payload)
+        else:
+            await self.loop.run_in_executor(self.executor, send_pkt,
+                                            conn, packet, self.algorithm)
+
+    async def listen_to_send(self, conn: Connection):
+        '''空闲的连接从共享队列中取出报文发送'''
+        while conn in self.connections:
+            self.idle.add(conn)
+            try:
+                item = await self.send_q.get()
+            finally:
+                self.idle.discard(conn)
+            lane, _, t_put, packet, has_slot = item
+            if conn not in self.connections:
+                # 连接已下线, 报文交由其他连接发送
+                if self.connections:
+                    self.send_q.put_nowait(item)
+                else:
+                    self._sent(lane, has_slot)
+                return
+            self.lanes[lane].record(t_put)
+            try:
+                self.inflight.sent(conn, packet)
+                await self._send_pkt(conn, packet)
+                self._sent_out(packet)
+            except SocketError as e:
+                if not self.ending:
+                    logging.warning(f'[Send] Conn-{id(conn):x}: {e}.')
+                self.pop(conn)
+                # 已记录的报文随 pop 重发, 不编号的报文在此重发
+                if packet.flag != Flag.FILE_CHUNK and not packet.seq:
+                    self.resend([packet])
+                return
+            except asyncio.CancelledError:
+                # 连接已被接收协程移除
+                if packet.flag != Flag.FILE_CHUNK and not packet.seq:
+                    self.resend([packet])
+                raise
+            finally:
+                self._sent(lane, has_slot)
+
+    async def _splice(self, conn: socket, splicer: Splicer, fd: int,
+                      offset: int, length: int):
+        '''将 socket 中的 length 字节写入文件: 等待可读在事件循环中完成,
+        写入文件可能因磁盘阻塞, 交给线程池'''
+        while length > 0:
+            try:
+                n_bytes = splicer.fill(conn, length)
+            except BlockingIOError:
+                await self._wait_ready(conn.fileno())
+                continue
+            drain = self.loop.run_in_executor(self.executor, splicer.drain,
+                                              fd, offset, n_bytes)
+            try:
+                await asyncio.shield(drain)
+            finally:
+                # 协程被取消时, 须等写入完成才能关闭管道和文件
+                if not drain.done():
+                    await asyncio.wait([drain])
+            offset += n_bytes
+            length -= n_bytes
+
+    async def _recv_chunk(self, conn: socket, splicer: Splicer,
+                          len_body: int) -> Packet:
+        '''接收数据块, 文件正在写入时将数据直接写入文件 (同 PacketReader)'''
+        chunk_head = bytearray(CHUNK_HEAD.size)
+        await self._recv_into(conn, memoryview(chunk_head))
+        fd, offset = splice_target(self.sink, chunk_head)
+        length = len_body - CHUNK_HEAD.size
+        if fd is None:
+            body = self.buffers.get(len_body)
+            body[:CHUNK_HEAD.size] = chunk_head
+            await self._recv_into(conn, body[CHUNK_HEAD.size:])
+            return Packet(Flag.FILE_CHUNK, body, chksum=0)
+
+        try:
+            await self._splice(conn, splicer, fd, offset, length)
+        finally:
+            os.close(fd)
+        return Packet(Flag.FILE_CHUNK, chunk_head,
+                      FileRange(None, offset, length), chksum=0)
+
+    async def listen_to_recv(self, conn: Connection):
+        conn_name = f'{id(conn):x}'
+        head = memoryview(bytearray(LEN_HEAD))
+        splicer = None
+        if self.sink is not None and Splicer.usable(conn, self.algorithm):
+            splicer = Splicer()
+        try:
+            while True:
+                try:
+                    await self._recv_into(conn, head)
+                    flag, seq, chksum, len_body = Packet.unpack_head(head)
+                    if splicer is not None and Splicer.wants(flag, len_body):
+                        packet = await self._recv_chunk(conn, splicer, len_body)
+                    else:
+                        body = self.buffers.get(len_body)
+                        await self._recv_into(conn, body)
+                        if (self.verify is not None
+                                and self.verify(body) != chksum):
+                            self.buffers.put(body)
+                            raise PacketError('checksum mismatch')
+                        packet = Packet(flag, body, chksum=chksum, seq=seq)
+
+                    self.traffic += packet.length
+                    if packet.flag == Flag.DETACH:
+                        stage, = packet.unpack_body()
+                        self.buffers.put(packet.body)
+                        if stage == 0:
+                            # 对端下线该连接, 回应后继续读
+                            await self.detach(conn, 1)
+                            if conn in self.tasks:
+                                continue
+                            return
+                        elif stage == 1:
+                            await self.detach(conn, 2)
+                        self.detached(conn)
+                        return
+                    self.dispatch(packet)
+                    logging.debug(f'[Recv] conn-{conn_name}: {packet}')
+                except ConnectionResetError:
+                    self.pop(conn)
+                    return
+                except SocketError as e:
+                    self.pop(conn)
+                    if not self.ending:  # 会话结束时对端关闭连接, 不必告警
+                        logging.warning(f'[Recv] Conn-{conn_name}: {e}.')
+                    return
+                except PacketError as e:
+                    self.pop(conn)
+                    logging.error(f'conn-{conn_name} received an error packet: {e}')
+                    return
+        finally:
+            if splicer is not None:
+                splicer.close()
+
+    def stop(self):
+        # 等待已提交的报文发送完毕
+        self.flushed.wait(TIMEOUT)
+        self.done.set()
+        try:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+        except RuntimeError:
+            pass  # 事件循环已关闭
+        self.log_stats()
+
+    def run(self):
+        if not self.connections:
+            raise ValueError('No connection')
+
+        asyncio.set_event_loop(self.loop)
+        self.send_q = asyncio.PriorityQueue()
+        self.executor = ThreadPoolExecutor(self.n_writers, 'ChannelWriter')
+        try:
+            self.loop.run_forever()
+        finally:
+            # 取消所有收发协程, 关闭连接
+            self.done.set()
+            for conn in list(self.tasks):
+                self.pop(conn)
+            tasks = asyncio.all_tasks(self.loop)
+            if tasks:
+                self.loop.run_until_complete(
+                    asyncio.gather(*tasks, return_exceptions=True))
+            self.executor.shutdown(wait=False)
+            self.loop.close()
+            self.inflight.clear()
+
+
+# 可选的连接池实现
+ENGINES: Dict[str, Callable[[Session], BaseConnectionPool]] = {
+    'thread': ConnectionPool,
+    'asyncio': AsyncConnectionPool,
+}
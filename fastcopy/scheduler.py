@@ -0,0 +1,130 @@
+'''连接池的发送调度策略
+
+ConnectionPool 中每个连接的发送线程在从共享队列取报文之前, 先经过调度器
+的 acquire 同意; 发送完毕后通过 finish 反馈发送耗时。
+'''
+from threading import Condition
+from time import monotonic
+from typing import Any, Callable, Dict, Optional
+
+from .config import CHUNK_SIZE
+
+
+class ChannelStats:
+    '''单个连接的发送统计'''
+    __slots__ = ('n_sent', 'n_packets', 'rate', 'latency', 'busy_since')
+
+    def __init__(self):
+        self.n_sent = 0  # 已发送字节数
+        self.n_packets = 0  # 已发送报文数
+        self.rate: Optional[float] = None  # 发送速率 (字节/秒), 平滑值
+        self.latency = 0.0  # 单个报文的发送耗时 (秒), 平滑值
+        self.busy_since: Optional[float] = None  # 当前报文的开始发送时间
+
+    def __str__(self) -> str:
+        rate = (self.rate or 0) / 1024 / 1024
+        return (f'ChannelStats(sent={self.n_sent}, rate={rate:.1f}MB/s, '
+                f'latency={self.latency * 1000:.1f}ms)')
+
+
+class Scheduler:
+    '''调度策略基类: 空闲的连接直接取下一个报文 (先到先得)'''
+    alpha = 0.2  # 平滑系数
+
+    def __init__(self):
+        self.cond = Condition()
+        self.stats: Dict[Any, ChannelStats] = {}
+
+    def add(self, conn):
+        with self.cond:
+            self.stats[conn] = ChannelStats()
+
+    def remove(self, conn):
+        with self.cond:
+            self.stats.pop(conn, None)
+            self.cond.notify_all()
+
+    def acquire(self, conn, backlog: Callable[[], int]):
+        '''连接取下一个报文之前调用, 可阻塞以让位给其他连接
+
+        backlog 返回发送队列中等待的报文数量
+        '''
+
+    def start(self, conn):
+        '''连接开始发送一个报文'''
+        with self.cond:
+            stats = self.stats.get(conn)
+            if stats is not None:
+                stats.busy_since = monotonic()
+
+    def finish(self, conn, length: int):
+        '''连接发送完一个报文, 更新其速率和耗时'''
+        with self.cond:
+            stats = self.stats.get(conn)
+            if stats is None:
+                return
+
+            elapsed = max(monotonic() - stats.busy_since, 1e-6)
+            stats.busy_since = None
+            stats.n_sent += length
+            stats.n_packets += 1
+            rate = length / elapsed
+            if stats.rate is None:
+                stats.rate, stats.latency = rate, elapsed
+            else:
+                stats.rate += self.alpha * (rate - stats.rate)
+                stats.latency += self.alpha * (elapsed - stats.latency)
+            self.cond.notify_all()
+
+
+class ThroughputScheduler(Scheduler):
+    '''按吞吐量与排队时延调度
+
+    估算每个连接发完下一个报文的时间: 正在发送的连接需先等当前报文发完。
+    若比自己更快完成的连接数已不少于队列中等待的报文数, 这些报文交给它们
+    更早送达, 当前连接让位等待, 直至有连接发送完毕或队列变长。
+    尚无统计数据的连接视为最快, 以便探测其速率。
+    '''
+    max_wait = 0.05  # 单次让位的最长等待时间
+
+    def __init__(self):
+        super().__init__()
+        self.packet_size = float(CHUNK_SIZE)  # 报文长度, 平滑值
+
+    def eta(self, stats: ChannelStats, now: float) -> float:
+        '''估算该连接发完下一个报文所需时间'''
+        if stats.rate is None:
+            return 0.0
+        cost = self.packet_size / stats.rate
+        if stats.busy_since is not None:
+            # 加上当前报文的剩余时间, 超时未发完的连接视为发生了拥塞,
+            # 超时越久估算的剩余时间越长
+            cost += abs(stats.latency - (now - stats.busy_since))
+        return cost
+
+    def acquire(self, conn, backlog: Callable[[], int]):
+        with self.cond:
+            while True:
+                mine = self.stats.get(conn)
+                if mine is None or mine.rate is None:
+                    return
+
+                now = monotonic()
+                my_eta = self.eta(mine, now)
+                n_faster = sum(1 for c, s in self.stats.items()
+                               if c is not conn and self.eta(s, now) < my_eta)
+                if n_faster < max(backlog(), 1):
+                    return
+                self.cond.wait(min(my_eta, self.max_wait))
+
+    def finish(self, conn, length: int):
+        with self.cond:
+            self.packet_size += self.alpha * (length - self.packet_size)
+        super().finish(conn, length)
+
+
+# 可选的调度策略
+SCHEDULERS = {
+    'fifo': Scheduler,
+    'throughput': ThroughputScheduler,
+}
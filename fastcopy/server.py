@@ -2,35 +2,50 @@
 
 import _socket
 import logging
+import re
+import ssl
 from argparse import ArgumentParser
-from json import loads
-from socket import AF_INET, SOCK_STREAM, SOL_SOCKET, SO_REUSEADDR, SO_REUSEPORT
+from json import dumps, loads
+from socket import (AF_INET, SHUT_WR, SOCK_STREAM, SOL_SOCKET, SO_REUSEADDR,
+                    SO_REUSEPORT)
 from socket import error as SocketError, timeout as TimeoutError
 from socket import socket
 from threading import Lock, Thread
-from typing import Dict
+from typing import Dict, Optional, Tuple
 from uuid import uuid4
 
 import daemon
 
-from .config import SERVER_ADDR, TIMEOUT
-from .network import Flag, Packet, send_pkt, recv_pkt
+from .config import LEN_HEAD, PROTOCOL_VERSION, SERVER_ADDR, TIMEOUT
+from .network import (CODECS, ENGINES, Flag, Packet, PacketError, Session,
+                      VersionError, fingerprint, send_pkt, recv_pkt,
+                      recv_into)
 from .transfer import Sender, Receiver, Porter
 
 
 class WatchDog(Thread):
-    def __init__(self, server: 'Server', sock: socket):
+    direct_timeout = 5  # 直连端口的握手超时 (秒)
+
+    def __init__(self, server: 'Server', sock: socket, direct=False):
         super().__init__(daemon=True)
         self.server = server
         self.sock = sock
+        self.direct = direct  # 是否来自直连数据端口
 
     def run(self):
         try:
             # 等待接收新连接的第一个数据报文
             logging.debug('[WatchDog] waiting for handshake from %s:%d'
                           % self.sock.getpeername())
-            self.sock.settimeout(60)
-            packet = recv_pkt(self.sock)
+            if self.direct:
+                self.sock.settimeout(self.direct_timeout)
+                if self.server.tls_context:
+                    self.sock = self.server.tls_context.wrap_socket(
+                        self.sock, server_side=True)
+                packet = self.recv_attach()
+            else:
+                self.sock.settimeout(60)
+                packet = recv_pkt(self.sock)
             self.sock.settimeout(TIMEOUT)
         except ConnectionResetError:
             logging.error('[WatchDog] connection reset by peer.')
@@ -40,21 +55,52 @@ class WatchDog(Thread):
             logging.error('[WatchDog] handshake timeout.')
             self.sock.close()
             return
+        except ssl.SSLError as e:
+            logging.error(f'[WatchDog] TLS handshake failed: {e}')
+            self.sock.close()
+            return
+        except VersionError as e:
+            logging.error(f'[WatchDog] bad handshake packet: {e}')
+            self.refuse(f'protocol version mismatch, the server speaks '
+                        f'version {PROTOCOL_VERSION}')
+            return
+        except PacketError as e:
+            # 报文格式或协议版本不匹配
+            logging.error(f'[WatchDog] bad handshake packet: {e}')
+            self.sock.close()
+            return
 
         if packet.flag == Flag.PULL or packet.flag == Flag.PUSH:
             # 创建 Porter
-            path, = packet.unpack_body()
-            porter = self.server.create_porter(packet.flag, path)
-            porter.conn_pool.add(self.sock)
-            porter.start()
+            request, = packet.unpack_body()
+            try:
+                porter = self.server.create_porter(packet.flag, request)
+            except (ValueError, TypeError, KeyError) as e:
+                # 会话参数无法协商, 告知客户端后断开
+                logging.error(f'[WatchDog] bad request: {e}')
+                send_pkt(self.sock, Packet.load(Flag.EXCEPTION, e))
+                self.sock.close()
+                return
 
-            # 将 SID 发送给客户端
-            packet = Packet.load(Flag.SID, porter.sid)
+            # 将 SID 及协商后的会话参数发送给客户端 (须先于 Porter 的任何报文)
+            params = dumps(porter.session.to_dict(), separators=(',', ':'))
+            packet = Packet.load(Flag.SID, porter.sid, params)
             send_pkt(self.sock, packet)
 
+            porter.conn_pool.add(self.sock)
+            porter.start()
+
         elif packet.flag == Flag.ATTACH:
             sid, = packet.unpack_body()
-            if not self.server.porters[sid].conn_pool.add(self.sock):
+            porter = self.server.porters.get(sid)
+            if porter is None:
+                logging.error(f'[WatchDog] unknown session: {sid.hex()}')
+                self.sock.close()
+            elif self.direct and porter.session.transport == 'ssh':
+                logging.error(f'[WatchDog] Task-{sid.hex()} is not allowed '
+                              'to connect directly')
+                self.sock.close()
+            elif not porter.conn_pool.add(self.sock):
                 self.sock.close()
 
         else:
@@ -62,32 +108,102 @@ class WatchDog(Thread):
             logging.debug('close conn')
             self.sock.close()
 
+    def refuse(self, msg: str):
+        '''以 EXCEPTION 告知对端拒绝的原因后断开
+
+        先关闭写端, 读完对端已发出的数据再关闭, 以免未读的数据使内核发出 RST,
+        对端来不及读到 EXCEPTION
+        '''
+        try:
+            send_pkt(self.sock, Packet.load(Flag.EXCEPTION, msg))
+            self.sock.shutdown(SHUT_WR)
+            self.sock.settimeout(1)
+            while self.sock.recv(65536):
+                pass
+        except SocketError:
+            pass
+        finally:
+            self.sock.close()
+
+    def recv_attach(self) -> Packet:
+        '''直连端口未经 SSH 认证, 只接受已有会话的后续连接:
+        先只读报头, 确认是 ATTACH 后才读取包体, 不为其他报文分配缓冲区'''
+        head = bytearray(LEN_HEAD)
+        recv_into(self.sock, memoryview(head))
+        flag, _, chksum, length = Packet.unpack_head(head)
+        if flag != Flag.ATTACH or length != CODECS[Flag.ATTACH].struct.size:
+            raise PacketError('only ATTACH is allowed on data port')
+
+        body = bytearray(length)
+        recv_into(self.sock, memoryview(body))
+        packet = Packet(flag, body)
+        if not packet.is_valid(chksum):
+            raise PacketError('checksum mismatch')
+        return packet
+
 
 class Server(Thread):
     max_tasks = 256  # 同时运行的最大任务数量
 
-    def __init__(self, max_conn) -> None:
+    def __init__(self, max_conn, engine='thread',
+                 data_addr: Optional[Tuple[str, int]] = None,
+                 certfile: Optional[str] = None,
+                 keyfile: Optional[str] = None) -> None:
         super().__init__(daemon=True)
         self.addr = SERVER_ADDR
         self.max_conn = max_conn  # 一个 Porter 的最大连接数
+        self.engine = engine  # 连接池的实现
         self.is_running = True
         self.mutex = Lock()
         self.porters: Dict[bytes, Porter] = {}
 
-    def create_porter(self, cli_flag: Flag, path: str) -> Porter:
+        # 直连数据端口: 会话仍经 SSH 建立, 后续连接可绕过 SSH 直接连入
+        self.data_addr = data_addr
+        self.tls_context: Optional[ssl.SSLContext] = None
+        self.fingerprint = ''
+        self.transports = ['ssh']
+        if data_addr and certfile:
+            self.tls_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            self.tls_context.load_cert_chain(certfile, keyfile)
+            self.fingerprint = self.load_fingerprint(certfile)
+            self.transports.append('tls')
+        elif data_addr:
+            self.transports.append('tcp')
+
+    @staticmethod
+    def load_fingerprint(certfile: str) -> str:
+        '''读取证书链中第一个证书的指纹, 经 SSH 告知客户端以便其校验'''
+        with open(certfile) as fp:
+            pem = re.search(r'-----BEGIN CERTIFICATE-----.+?'
+                            r'-----END CERTIFICATE-----', fp.read(), re.S)
+        if pem is None:
+            raise ValueError(f'no certificate found in {certfile}')
+        return fingerprint(ssl.PEM_cert_to_DER_cert(pem.group()))
+
+    def create_porter(self, cli_flag: Flag, request: str) -> Porter:
         '''创建新 Porter'''
         sid = uuid4().bytes
+        _request = loads(request)
+
+        # 协商会话参数
+        session = Session(**_request['params']).negotiate(self.max_conn,
+                                                          self.transports)
+        if session.transport != 'ssh':
+            session.data_port = self.data_addr[1]
+            session.fingerprint = self.fingerprint
+        logging.debug(f'[Server] Task-{sid.hex()} {session}')
+
         if cli_flag == Flag.PULL:
-            _path = loads(path)
-            srcs = _path['srcs']
-            include = _path['include']
-            exclude = _path['exclude']
-            logging.debug(f'[Server] New task-{sid.hex()} for send {path}')
-            self.porters[sid] = Sender(sid, srcs, self.max_conn,
-                                       include, exclude)
+            srcs = _request['srcs']
+            include = _request['include']
+            exclude = _request['exclude']
+            logging.debug(f'[Server] New task-{sid.hex()} for send {srcs}')
+            self.porters[sid] = Sender(sid, srcs, session, include, exclude,
+                                      self.engine)
         else:
-            logging.debug(f'[Server] New task-{sid.hex()} for recv {path}')
-            self.porters[sid] = Receiver(sid, path, self.max_conn)
+            dst = _request['dst']
+            logging.debug(f'[Server] New task-{sid.hex()} for recv {dst}')
+            self.porters[sid] = Receiver(sid, dst, session, self.engine)
         return self.porters[sid]
 
     def close_all_porters(self):
@@ -129,20 +245,33 @@ class Server(Thread):
             sock.close()
             raise
 
-    def run(self):
-        self.srv_sock = self.create_socket_server(self.addr,
-                                                  backlog=2048,
-                                                  reuse_port=True)
-        logging.info('[Server] Listening to %s:%d' % self.addr)
+    def serve(self, srv_sock: socket, direct=False):
         while self.is_running:
             # wait for new connection
-            cli_sock, cli_addr = self.srv_sock.accept()
+            cli_sock, cli_addr = srv_sock.accept()
             logging.info('[Server] Accept new connection: %s:%s' % cli_addr)
 
             # create a WatchDog for handshake
-            dog = WatchDog(self, cli_sock)
+            dog = WatchDog(self, cli_sock, direct)
             dog.start()
 
+    def run(self):
+        self.srv_sock = self.create_socket_server(self.addr,
+                                                  backlog=2048,
+                                                  reuse_port=True)
+        logging.info('[Server] Listening to %s:%d' % self.addr)
+
+        if self.data_addr:
+            self.data_sock = self.create_socket_server(self.data_addr,
+                                                       backlog=2048,
+                                                       reuse_port=True)
+            logging.info(f'[Server] Data port listening to {self.data_addr} '
+                         f'({self.transports[-1]})')
+            Thread(target=self.serve, args=(self.data_sock, True),
+                   daemon=True).start()
+
+        self.serve(self.srv_sock)
+
 
 def main():
     parser = ArgumentParser()
@@ -158,6 +287,31 @@ def main():
                         default=128,
                         help='max concurrent connections of one task.')
 
+    parser.add_argument('--engine',
+                        metavar='ENGINE',
+                        default='thread',
+                        choices=list(ENGINES),
+                        help=('connection pool engine, `asyncio` drives all '
+                              'connections of a task with one thread. '
+                              'Choices: thread | asyncio'))
+
+    parser.add_argument('--data-port',
+                        metavar='[HOST:]PORT',
+                        default=None,
+                        help=('open a data port for clients to connect '
+                              'directly, bypassing SSH. Only for trusted '
+                              'networks unless --cert is given'))
+
+    parser.add_argument('--cert',
+                        metavar='FILE',
+                        default=None,
+                        help='TLS certificate (PEM) to encrypt the data port')
+
+    parser.add_argument('--key',
+                        metavar='FILE',
+                        default=None,
+                        help='private key of the TLS certificate')
+
     parser.add_argument('--loglevel',
                         metavar='LEVEL',
                         default='error',
@@ -166,6 +320,13 @@ def main():
                               'Choices: debug | info | warning | error'))
 
     args = parser.parse_args()
+    if args.data_port:
+        host, _, port = args.data_port.rpartition(':')
+        data_addr = (host or '0.0.0.0', int(port))
+    elif args.cert:
+        parser.error('--cert requires --data-port')
+    else:
+        data_addr = None
 
     loglevel = getattr(logging, args.loglevel.upper())
     logformat = '%(asctime)s %(levelname)7s %(module)s.%(lineno)s: %(message)s'
@@ -176,14 +337,16 @@ def main():
                                 level=loglevel,
                                 datefmt='%Y-%m-%d %H:%M:%S',
                                 format=logformat)
-            server = Server(args.concurrency)
+            server = Server(args.concurrency, args.engine, data_addr,
+                            args.cert, args.key)
             server.start()
             server.join()
     else:
         logging.basicConfig(level=loglevel,
                             datefmt='%Y-%m-%d %H:%M:%S',
                             format=logformat)
-        server = Server(args.concurrency)
+        server = Server(args.concurrency, args.engine, data_addr,
+                        args.cert, args.key)
         server.start()
         server.join()
 
@@ -0,0 +1,123 @@
+'''TCP 连接调优
+
+按会话参数设置收发缓冲区、拥塞控制算法等, 并读回实际生效的值以便统计。
+'''
+import logging
+import sys
+from ipaddress import ip_address
+from socket import (AF_INET, AF_INET6, IPPROTO_TCP, SOL_SOCKET, SO_RCVBUF,
+                    SO_SNDBUF, TCP_NODELAY, socket)
+from typing import Optional, Tuple
+
+try:
+    from socket import TCP_CONGESTION, TCP_NOTSENT_LOWAT
+except ImportError:
+    # 非 Linux 平台
+    TCP_CONGESTION = TCP_NOTSENT_LOWAT = None  # type: ignore
+
+# 有 CAP_NET_ADMIN 权限时可突破 net.core.[wr]mem_max 的限制 (仅 Linux)
+if sys.platform == 'linux':
+    SO_SNDBUFFORCE, SO_RCVBUFFORCE = 32, 33
+else:
+    SO_SNDBUFFORCE = SO_RCVBUFFORCE = None
+
+
+def read_sysctl(name: str) -> str:
+    '''读取内核参数, 不存在时返回空串'''
+    try:
+        with open(f'/proc/sys/{name.replace(".", "/")}') as fp:
+            return fp.read().strip()
+    except OSError:
+        return ''
+
+
+def congestion_controls() -> Tuple[str, ...]:
+    '''本机可用的拥塞控制算法'''
+    names = read_sysctl('net.ipv4.tcp_available_congestion_control')
+    return tuple(names.split())
+
+
+class SocketTuning:
+    '''单个连接实际生效的调优参数'''
+    __slots__ = ('nodelay', 'notsent_lowat', 'sndbuf', 'rcvbuf',
+                 'congestion')
+
+    def __init__(self):
+        self.nodelay = False
+        self.notsent_lowat = 0  # 0 表示未设置
+        self.sndbuf = 0  # 内核报告的缓冲区大小 (含簿记开销, 约为设定值的 2 倍)
+        self.rcvbuf = 0
+        self.congestion = ''
+
+    def __str__(self) -> str:
+        return (f'SocketTuning(nodelay={self.nodelay}, '
+                f'lowat={self.notsent_lowat}, sndbuf={self.sndbuf}, '
+                f'rcvbuf={self.rcvbuf}, cc={self.congestion or "-"})')
+
+
+def set_buffer(sock: socket, option: int, force: Optional[int], size: int,
+               sysctl: str) -> bool:
+    '''设置收发缓冲区
+
+    普通用户设置的值会被截断到 sysctl 上限, 小于内核自动调节所能达到的大小,
+    此时宁可不设置。
+    '''
+    if force is not None:
+        try:
+            sock.setsockopt(SOL_SOCKET, force, size)
+            return True
+        except OSError:
+            pass  # 没有权限
+
+    limit = int(read_sysctl(sysctl) or 0)
+    if limit and size > limit:
+        logging.warning(f'[Socket] buffer size {size} exceeds {sysctl} '
+                        f'({limit}), keep kernel autotuning')
+        return False
+    sock.setsockopt(SOL_SOCKET, option, size)
+    return True
+
+
+def tune_socket(sock: socket, buf_size=0, congestion='', lowat=0,
+                wan: Optional[bool] = None) -> SocketTuning:
+    '''调优 TCP 连接
+
+    - 关闭 Nagle 算法, 控制类的小报文无需等待
+    - TCP_NOTSENT_LOWAT 限制内核中尚未发出的数据量, 使报文留在发送队列中,
+      控制通道的报文得以插队
+    - buf_size 为 0 时由内核自动调节缓冲区, 否则按带宽时延积设置
+    - 本机回环连接 (如 SSH 转发) 只做前两项
+    - 非 TCP 连接 (如 socketpair) 不做调优
+    '''
+    tuning = SocketTuning()
+    if sock.family not in (AF_INET, AF_INET6):
+        return tuning
+    try:
+        if wan is None:
+            wan = not ip_address(sock.getpeername()[0]).is_loopback
+        sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+        if lowat and TCP_NOTSENT_LOWAT is not None:
+            sock.setsockopt(IPPROTO_TCP, TCP_NOTSENT_LOWAT, lowat)
+            tuning.notsent_lowat = lowat
+        if wan and buf_size:
+            set_buffer(sock, SO_SNDBUF, SO_SNDBUFFORCE, buf_size,
+                       'net.core.wmem_max')
+            set_buffer(sock, SO_RCVBUF, SO_RCVBUFFORCE, buf_size,
+                       'net.core.rmem_max')
+        if wan and congestion and TCP_CONGESTION is not None:
+            try:
+                sock.setsockopt(IPPROTO_TCP, TCP_CONGESTION,
+                                congestion.encode())
+            except OSError as e:
+                logging.warning(f'[Socket] congestion control `{congestion}` '
+                                f'is not available: {e}')
+
+        tuning.nodelay = bool(sock.getsockopt(IPPROTO_TCP, TCP_NODELAY))
+        tuning.sndbuf = sock.getsockopt(SOL_SOCKET, SO_SNDBUF)
+        tuning.rcvbuf = sock.getsockopt(SOL_SOCKET, SO_RCVBUF)
+        if TCP_CONGESTION is not None:
+            name = sock.getsockopt(IPPROTO_TCP, TCP_CONGESTION, 16)
+            tuning.congestion = name.rstrip(b'\0').decode()
+    except OSError as e:
+        logging.warning(f'[Socket] tuning failed: {e}')
+    return tuning
@@ -1,20 +1,27 @@
+import errno
 import os
 import re
 import logging
+import mmap
+import zlib
 from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from glob import has_magic, iglob
 from hashlib import md5
-from math import ceil
+from itertools import chain
 from pathlib import Path
-from queue import Empty
-from threading import Semaphore, Thread
-from typing import Deque, Dict, Generator, Iterable, List, Tuple, Union
+from queue import Empty, SimpleQueue
+from threading import Lock, Semaphore, Thread
+from time import monotonic
+from typing import (Callable, Deque, Dict, Generator, Iterable, List,
+                    Optional, Set, Tuple, Union)
 
 from rich.progress import (BarColumn, Progress, TaskID, SpinnerColumn,
                            TextColumn, TransferSpeedColumn)
 
-from .config import CHUNK_SIZE
-from .network import Flag, ConnectionPool, Packet
+from .config import CHUNK_SIZE, MANIFEST_BATCH
+from .network import (CODEC_RAW, COMPRESSIONS, ENGINES, Buffer, FileRange,
+                      Flag, Packet, Session)
 
 
 trans_progress = Progress(
@@ -75,6 +82,8 @@ class FileInfo:
     '''文件基础信息'''
     __slots__ = ('id', 'perm', 'size', 'mtime', 'chksum', 'relpath', 'abspath',
                  '_values')
+    mmap_min_size = 0  # 不为 0 时, 不小于此大小的文件通过 mmap 读取 (见 imap)
+    mmap_window = 1024 * 1024 * 16  # 每次映射的区间长度
 
     def __init__(self, id: int, perm: int, size: int,
                  mtime: float, chksum: bytes, relpath: bytes):
@@ -104,19 +113,15 @@ class FileInfo:
     def name(self) -> str:
         return self.abspath.name
 
-    @property
-    def n_chunks(self):
-        return ceil(self.size / CHUNK_SIZE)
-
     @classmethod
-    def load(cls, file_id: int, fullpath: Path, relpath: Path):
+    def load(cls, file_id: int, fullpath: Path, relpath: Path, verify=True):
         # 读取文件状态信息
         stat = fullpath.stat()
         f_info = cls(file_id,
-                     stat.st_mode,   # 权限, 2 Bytes
-                     stat.st_size,   # 大小, 8 Bytes
-                     stat.st_mtime,  # 修改时间, 8 Bytes
-                     cls.hash(fullpath),  # 文件 MD5 校验码
+                     stat.st_mode,   # 权限
+                     stat.st_size,   # 大小
+                     stat.st_mtime,  # 修改时间
+                     cls.hash(fullpath) if verify else b'',  # 文件 MD5 校验码
                      bytes(relpath))
         f_info.abspath = fullpath
         return f_info
@@ -146,36 +151,85 @@ class FileInfo:
             open(self.abspath, 'w').close()
             self.set_stat()
 
-    def iread(self) -> Generator[Packet, None, None]:
-        '''封装文件数据块报文'''
+    def allocate(self, fd: int):
+        '''按文件大小预分配磁盘空间, 使乱序到达的数据块落在连续的区段中,
+        空间不足时在接收数据之前报错
+
+        平台或文件系统不支持 posix_fallocate 时退回 ftruncate, 只设置文件大小
+        '''
+        if hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(fd, 0, self.size)
+            except OSError as e:
+                if e.errno in (errno.ENOSPC, errno.EDQUOT, errno.EFBIG):
+                    raise
+                logging.debug(f'[Receiver] fallocate {self.name}: {e}')
+        # 已存在的旧文件可能更大, 截断到目标大小
+        os.ftruncate(fd, self.size)
+
+    def iread(self, chunk_size: int) -> Generator[Tuple[int, Buffer],
+                                                  None, None]:
+        '''按数据块迭代读取, 产出 (偏移量, 数据块)
+
+        默认逐块 read; 开启 mmap 时, 大文件通过 mmap 读取, 数据块为映射区的
+        memoryview, 无需拷贝, 不支持 mmap 的文件 (如 procfs、部分 FUSE) 仍逐块 read
+        '''
         with open(self.abspath, 'rb') as fp:
-            seq = 0
+            size = os.fstat(fp.fileno()).st_size
+            if self.mmap_min_size and size >= self.mmap_min_size:
+                chunks = self.imap(fp.fileno(), size, chunk_size)
+                try:
+                    first = next(chunks)
+                except (OSError, ValueError) as e:
+                    logging.debug(f'[Sender] mmap {self.name} failed: {e}')
+                else:
+                    yield first
+                    yield from chunks
+                    return
+
+            offset = 0
             # 读取单位长度的数据，如果为空则跳出循环
             while True:
-                chunk = fp.read(CHUNK_SIZE)
+                chunk = fp.read(chunk_size)
                 if chunk:
-                    yield Packet.load(Flag.FILE_CHUNK, self.id, seq, chunk)
-                    seq += 1
+                    yield offset, chunk
+                    offset += len(chunk)
                 else:
                     break
 
-    def iwrite(self) -> Generator[None, Tuple[int, bytes], None]:
-        '''按数据块迭代写入'''
-        # 确保文件的上级目录存在
-        self.abspath.parent.mkdir(mode=0o755, parents=True, exist_ok=True)
-
-        # 定义文件所有数据块编号集
-        seqs = {i for i in range(self.n_chunks)}
-
-        # 开始迭代写入
-        mode = 'rb+' if self.abspath.is_file() else 'wb'
-        with open(self.abspath, mode) as fp:
-            while seqs:
-                seq, chunk = yield
-                if seq in seqs:
-                    fp.seek(seq * CHUNK_SIZE)
-                    fp.write(chunk)
-                    seqs.remove(seq)
+    def imap(self, fd: int, size: int, chunk_size: int
+             ) -> Generator[Tuple[int, memoryview], None, None]:
+        '''分段映射文件, 产出 (偏移量, 数据块)
+
+        映射区不主动关闭, 由引用它的数据块报文全部释放后自动解除映射,
+        因此常驻内存受发送窗口限制, 而非文件大小。
+        传输过程中文件被截断 (如 logrotate 的 copytruncate) 时, 访问映射区会
+        触发 SIGBUS 使整个进程退出, 因此只由客户端按 --mmap 开启, fcpd 从不使用
+        '''
+        n_chunks = max(self.mmap_window // chunk_size, 1)
+        offset = 0
+        while offset < size:
+            # 映射的起点须对齐到 ALLOCATIONGRANULARITY
+            start = offset - offset % mmap.ALLOCATIONGRANULARITY
+            end = min(size, offset + n_chunks * chunk_size)
+            mm = mmap.mmap(fd, end - start, offset=start,
+                           access=mmap.ACCESS_READ)
+            if hasattr(mm, 'madvise'):
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+            view = memoryview(mm)
+            for pos in range(offset, end, chunk_size):
+                yield pos, view[pos - start:min(pos + chunk_size, end) - start]
+            offset = end
+            del view, mm
+
+    def iranges(self, chunk_size: int) -> Generator[Tuple[int, FileRange],
+                                                    None, None]:
+        '''按数据块迭代文件区间, 产出 (偏移量, 区间), 数据在发送时才读取'''
+        path = str(self.abspath)
+        size = os.stat(path).st_size
+        for offset in range(0, size, chunk_size):
+            yield offset, FileRange(path, offset,
+                                    min(chunk_size, size - offset))
 
     @staticmethod
     def hash(filepath: Path) -> bytes:
@@ -190,19 +244,272 @@ class FileInfo:
         return hasher.digest()
 
     def is_vaild(self):
-        '''检查文件校验和'''
-        return (self.abspath.is_file()
-                and self.hash(self.abspath) == self.chksum)
+        '''检查文件校验和, 没有校验和时只比较文件大小和修改时间'''
+        if not self.abspath.is_file():
+            return False
+        elif self.chksum:
+            return self.hash(self.abspath) == self.chksum
+        else:
+            stat = self.abspath.stat()
+            return (stat.st_size == self.size
+                    and abs(stat.st_mtime - self.mtime) < 0.001)
+
+
+class ChunkCompressor:
+    '''数据块压缩
+
+    zlib 在压缩时会释放 GIL, 因此用线程池即可实现多核并行。
+    每个文件先对首个数据块取样试压缩, 压缩率不理想时 (如 .gz、.parquet、
+    多媒体等已压缩的文件) 该文件的所有数据块均不再压缩。
+    '''
+    sample_size = 1024 * 64  # 取样大小
+    min_ratio = 0.9  # 压缩后小于原大小的 90% 才值得压缩
+    min_size = 512  # 太小的数据块不压缩
+
+    def __init__(self, method: str, n_workers=min(8, os.cpu_count() or 1)):
+        self.codec = COMPRESSIONS.index(method)
+        self.n_workers = n_workers
+        if method == 'none':
+            self.executor = None
+        else:
+            self.executor = ThreadPoolExecutor(n_workers, 'Compressor')
+
+    def is_compressible(self, chunk: Buffer) -> bool:
+        '''取样检查数据是否值得压缩'''
+        sample = chunk[:self.sample_size]
+        return len(zlib.compress(sample, 1)) < len(sample) * self.min_ratio
+
+    def will_compress(self, path: Path) -> bool:
+        '''检查文件是否会被压缩'''
+        if self.executor is None:
+            return False
+        with open(path, 'rb') as fp:
+            return self.is_compressible(fp.read(self.sample_size))
+
+    def compress(self, f_id: int, offset: int, chunk: Buffer) -> Packet:
+        '''压缩一个数据块, 压缩无收益时仍发送原始数据'''
+        if len(chunk) >= self.min_size:
+            data = zlib.compress(chunk, 1)
+            if len(data) < len(chunk):
+                return Packet.load(Flag.FILE_CHUNK, f_id, offset, self.codec, data)
+        return Packet.load(Flag.FILE_CHUNK, f_id, offset, CODEC_RAW, chunk)
+
+    def pack_chunks(self, f_id: int, chunks: Iterable[Tuple[int, Buffer]]
+                    ) -> Generator[Tuple[Packet, int], None, None]:
+        '''将数据块封装为报文, 按原顺序产出 (报文, 原始数据长度)'''
+        chunks = iter(chunks)
+        first = next(chunks, None)
+        if first is None:
+            return
+
+        if self.executor is None or not self.is_compressible(first[1]):
+            # 不压缩
+            for offset, chunk in chain([first], chunks):
+                yield (Packet.load(Flag.FILE_CHUNK, f_id, offset, CODEC_RAW,
+                                   chunk), len(chunk))
+            return
+
+        # 并行压缩, 最多同时有 2 * n_workers 个数据块在压缩
+        pending: Deque[Tuple[Future, int]] = deque()
+        for offset, chunk in chain([first], chunks):
+            future = self.executor.submit(self.compress, f_id, offset, chunk)
+            pending.append((future, len(chunk)))
+            if len(pending) >= self.n_workers * 2:
+                future, n_raw = pending.popleft()
+                yield future.result(), n_raw
+
+        while pending:
+            future, n_raw = pending.popleft()
+            yield future.result(), n_raw
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+
+
+# 暂存在写入线程中的数据块: file_id: [(fd, offset, 数据, 报文), ...]
+Pending = Dict[int, List[Tuple[int, int, Buffer, Packet]]]
+
+
+class ChunkWriter:
+    '''数据块写入线程池
+
+    数据块按 file_id 分片交给固定的线程, 同一文件的数据块总由同一线程解压并写入,
+    关闭文件的请求也排在该文件已提交的数据块之后。
+    每写完一个数据块调用一次 callback(file_id, 报文, 写入的字节数, 异常),
+    报文须由 callback 归还给连接池, 因此积压的数据块受流量控制的额度限制。
+
+    磁盘跟不上网络时, 队列中会积压多个数据块: 写入线程先将它们全部取出暂存,
+    同一文件中相邻的数据块 (可能乱序到达) 合并为一次 os.pwritev。
+    队列取空、暂存超过 max_bytes 或最早的数据块暂存超过 flush_timeout 时落盘,
+    因此队列空闲时不会额外增加延迟。
+
+    文件的预分配也排在该文件的线程上执行, 完成后调用 on_allocated(file_id, 异常)。
+    不支持 fallocate 的文件系统 (如 NFSv3) 上 posix_fallocate 会逐块写满文件,
+    放在接收循环中会阻塞报文的处理。
+    '''
+    flush_timeout = 0.01  # 数据块最长暂存时间 (秒)
+    # 单次 pwritev 最多合并的数据块数, 不支持 pwritev 的平台逐块写入
+    max_iov = os.sysconf('SC_IOV_MAX') if hasattr(os, 'pwritev') else 1
+
+    def __init__(self, callback: Callable[[int, Packet, int,
+                                           Optional[Exception]], None],
+                 on_allocated: Callable[[int, Optional[Exception]], None],
+                 n_workers=4, max_bytes=1024 * 1024 * 4):
+        self.callback = callback
+        self.on_allocated = on_allocated
+        self.max_bytes = max_bytes  # 每个线程最多暂存的字节数
+        self.queues: List[SimpleQueue] = [SimpleQueue()
+                                          for _ in range(n_workers)]
+        self.threads = [Thread(target=self.work, args=(queue,),
+                               name='ChunkWriter', daemon=True)
+                        for queue in self.queues]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def write(self, f_id: int, fd: int, offset: int, packet: Packet):
+        '''提交一个数据块报文, 写入 fd 的 offset 处'''
+        self.queues[f_id % len(self.queues)].put((f_id, fd, offset, packet))
+
+    def allocate(self, f_id: int, fd: int, f_info: FileInfo):
+        '''为文件预分配磁盘空间, 完成后调用 on_allocated'''
+        self.queues[f_id % len(self.queues)].put((f_id, fd, 0, f_info))
+
+    def close(self, f_id: int, fd: int):
+        '''该文件已提交的数据块写完后关闭 fd'''
+        self.queues[f_id % len(self.queues)].put((f_id, fd, 0, None))
+
+    @staticmethod
+    def pwritev(fd: int, buffers: List[Buffer], offset: int) -> int:
+        '''将多个缓冲区依次写入 offset 处, 返回写入的字节数'''
+        views = deque(memoryview(buf) for buf in buffers)
+        n_bytes = sum(len(view) for view in views)
+        while views:
+            if len(views) == 1:
+                n_written = os.pwrite(fd, views[0], offset)
+            else:
+                n_written = os.pwritev(fd, views, offset)
+            offset += n_written
+            # 跳过已写完的缓冲区
+            while views and n_written >= len(views[0]):
+                n_written -= len(views.popleft())
+            if n_written:
+                views[0] = views[0][n_written:]
+        return n_bytes
+
+    def flush(self, f_id: int, chunks: List[Tuple[int, int, Buffer, Packet]]
+              ) -> int:
+        '''将一个文件暂存的数据块按偏移量排序, 相邻的合并写入, 返回写入次数'''
+        chunks.sort(key=lambda chunk: chunk[1])
+        n_writes = 0
+        start = 0
+        while start < len(chunks):
+            fd, offset, data, _ = chunks[start]
+            end = start + 1
+            next_offset = offset + len(data)
+            while (end < len(chunks) and end - start < self.max_iov
+                   and chunks[end][1] == next_offset):
+                next_offset += len(chunks[end][2])
+                end += 1
+
+            run = chunks[start:end]
+            error = None
+            try:
+                self.pwritev(fd, [chunk[2] for chunk in run], offset)
+            except OSError as e:
+                error = e
+            n_writes += 1
+            for _, _, data, packet in run:
+                self.callback(f_id, packet, 0 if error else len(data), error)
+            start = end
+        return n_writes
+
+    def work(self, queue: SimpleQueue):
+        pending: Pending = {}
+        n_pending = 0  # 暂存的字节数
+        since = 0.0  # 最早暂存的时间
+        n_chunks = n_writes = 0
+
+        while True:
+            try:
+                task = queue.get(block=not pending)
+            except Empty:
+                task = ()  # 队列已取空, 落盘暂存的数据块
+
+            if task:
+                f_id, fd, offset, packet = task
+                if packet is None:
+                    # 关闭文件前先写入其暂存的数据块
+                    chunks = pending.pop(f_id, None)
+                    if chunks:
+                        n_pending -= sum(len(chunk[2]) for chunk in chunks)
+                        n_writes += self.flush(f_id, chunks)
+                    os.close(fd)
+                    continue
+                elif isinstance(packet, FileInfo):
+                    # 预分配可能很慢, 先落盘暂存的数据块, 归还其占用的额度
+                    for pending_id, chunks in pending.items():
+                        n_writes += self.flush(pending_id, chunks)
+                    pending.clear()
+                    n_pending = 0
+                    try:
+                        packet.allocate(fd)
+                    except OSError as e:
+                        self.on_allocated(f_id, e)
+                    else:
+                        self.on_allocated(f_id, None)
+                    continue
+
+                try:
+                    _, _, codec, data = packet.unpack_body()
+                    if codec != CODEC_RAW:
+                        data = zlib.decompress(data)
+                except zlib.error as e:
+                    self.callback(f_id, packet, 0, e)
+                    continue
+                if not pending:
+                    since = monotonic()
+                pending.setdefault(f_id, []).append((fd, offset, data, packet))
+                n_pending += len(data)
+                n_chunks += 1
+                if (n_pending < self.max_bytes
+                        and monotonic() - since < self.flush_timeout):
+                    continue
+
+            # 落盘所有暂存的数据块
+            for f_id, chunks in pending.items():
+                n_writes += self.flush(f_id, chunks)
+            pending.clear()
+            n_pending = 0
+
+            if task is None:
+                logging.debug(f'[Writer] {n_chunks} chunks in '
+                              f'{n_writes} writes')
+                return
+
+    def shutdown(self):
+        '''等待已提交的数据块写完'''
+        for queue in self.queues:
+            queue.put(None)
+        for thread in self.threads:
+            if thread.is_alive():
+                thread.join()
 
 
 class Sender(Thread):
-    def __init__(self, sid: bytes, src_paths: List[str], pool_size: int,
-                 include=None, exclude=None):
+    def __init__(self, sid: bytes, src_paths: List[str], session: Session,
+                 include=None, exclude=None, engine='thread'):
         super().__init__(daemon=True)
 
         self.sid = sid
         self.srcs = src_paths
-        self.conn_pool = ConnectionPool(pool_size)
+        self.session = session
+        self.conn_pool = ENGINES[engine](session)
+        self.compressor = ChunkCompressor(session.compress)
+        # 无需校验和时, 未压缩的数据块可由 os.sendfile 直接发送
+        self.zero_copy = session.chksum == 'none' and hasattr(os, 'sendfile')
         self.include = include or '*'
         self.exclude = exclude or []
         self.tree: Dict[int, Union[DirInfo, FileInfo]] = {}
@@ -278,10 +585,18 @@ class Sender(Thread):
             for paths in cls.checkout_paths(_path, include, exclude):
                 yield paths
 
+    def send_manifest(self, batch: List[Union[DirInfo, FileInfo]]):
+        '''将一批 文件/目录 信息发送给接收端'''
+        if batch:
+            self.conn_pool.send(Packet.load(Flag.MANIFEST, *batch))
+            batch.clear()
+
     def prepare_all_files(self):
         '''整理要传输的文件列表'''
         _id = 0
         relpaths = set()
+        batch: List[Union[DirInfo, FileInfo]] = []
+        t_flush = monotonic()
         for src_path in self.srcs:
             items = self.search_files_and_dirs(src_path,
                                                self.include,
@@ -291,22 +606,28 @@ class Sender(Thread):
                     # 整理目录树
                     relpaths.add(relpath)
                     if fullpath.is_file():
-                        inf_cls, flag = FileInfo, Flag.FILE_INFO
+                        inf_cls = FileInfo
+                        self.tree[_id] = FileInfo.load(_id, fullpath, relpath,
+                                                       self.session.verify)
                     else:
-                        inf_cls, flag = DirInfo, Flag.DIR_INFO
-                    self.tree[_id] = inf_cls.load(_id, fullpath, relpath)
-
-                    # 将 文件/目录 信息发送给接收端
-                    info_pkt = Packet.load(flag, *self.tree[_id])
-                    self.conn_pool.send(info_pkt)
+                        inf_cls = DirInfo
+                        self.tree[_id] = DirInfo.load(_id, fullpath, relpath)
+                    batch.append(self.tree[_id])
                     logging.debug(f'[Sender] Found {inf_cls.__name__}: '
                                   f'id={_id} path={relpath.as_posix()}')
 
+                    # 攒够一批或等待过久时, 将 文件/目录 信息发送给接收端
+                    if (len(batch) >= MANIFEST_BATCH
+                            or monotonic() - t_flush > 0.2):
+                        self.send_manifest(batch)
+                        t_flush = monotonic()
+
                     _id += 1
                 else:
                     logging.debug(f'[Sender] Name conflict: '
                                   f'{relpath.as_posix()}, ignore.')
 
+        self.send_manifest(batch)
         if _id == 0:
             packet = Packet.load(Flag.EXCEPTION, 'No such file or directory')
         else:
@@ -314,6 +635,29 @@ class Sender(Thread):
         self.conn_pool.send(packet)
         logging.info(f'[Sender] Num of files and dirs: {_id}')
 
+    def send_file(self, f_info: FileInfo):
+        '''发送文件数据块'''
+        # 添加进度条任务
+        task_id = trans_progress.add_task(
+            f'upload-{f_info.name}',
+            filename=f_info.name,
+            total=f_info.size,
+            start=True
+        )
+
+        chunk_size = self.session.chunk_size
+        if self.zero_copy and not self.compressor.will_compress(f_info.abspath):
+            packets = ((Packet.load(Flag.FILE_CHUNK, f_info.id, offset,
+                                    CODEC_RAW, f_range), len(f_range))
+                       for offset, f_range in f_info.iranges(chunk_size))
+        else:
+            chunks = f_info.iread(chunk_size)
+            packets = self.compressor.pack_chunks(f_info.id, chunks)
+
+        for packet, n_raw in packets:
+            self.conn_pool.send(packet)
+            trans_progress.update(task_id, advance=n_raw)
+
     def run(self):
         logging.debug(f'[Sender] Sender-{self.sid.hex()[:8]} is running')
         self.conn_pool.start()  # 启动网络连接池
@@ -339,21 +683,8 @@ class Sender(Thread):
                 break
 
             if packet.flag == Flag.FILE_READY:
-                f_id, = packet.unpack_body()
-                f_info = self.tree[f_id]
-
-                # 添加进度条任务
-                task_id = trans_progress.add_task(
-                    f'upload-{f_info.name}',
-                    filename=f_info.name,
-                    total=f_info.size,
-                    start=True
-                )
-
-                # 发送文件数据块
-                for chunk_packet in f_info.iread():
-                    self.conn_pool.send(chunk_packet)
-                    trans_progress.update(task_id, advance=chunk_packet.length)
+                for f_id in packet.unpack_body():
+                    self.send_file(self.tree[f_id])
 
             elif packet.flag == Flag.DONE:
                 logging.info('[Sender] All files are processed, exit.')
@@ -363,16 +694,19 @@ class Sender(Thread):
                 logging.error(f'[Sender] Unknow packet: {packet}')
 
         self.conn_pool.stop()
+        self.compressor.shutdown()
         logging.debug(f'Sender-{self.sid.hex()[:8]} exit')
 
 
 class Receiver(Thread):
-    def __init__(self, sid: bytes, dst_path: str, pool_size: int) -> None:
+    def __init__(self, sid: bytes, dst_path: str, session: Session,
+                 engine='thread') -> None:
         super().__init__(daemon=True)
 
         self.sid = sid
         self.dst_path = Sender.abspath(dst_path)
-        self.conn_pool = ConnectionPool(pool_size)
+        self.session = session
+        self.conn_pool = ENGINES[engine](session)
 
         self.base_dir = Path.home()
         self.size = 0
@@ -380,10 +714,27 @@ class Receiver(Thread):
         self.n_recv = 0
         self.total = 0xffffffff
         self.use_custom_name = False
-        self.concurrency = Semaphore(8)  # 允许同时写入的文件数
+        self.concurrency = Semaphore(session.file_window)  # 同时写入的文件数
         self.files: Dict[int, FileInfo] = {}
-        self.iwriters: Dict[int, Generator] = {}
         self.ready_files: Deque[int] = deque()
+
+        # 正在写入的文件
+        self.fds: Dict[int, int] = {}  # file_id: 文件描述符
+        self.fd_lock = Lock()
+        self.offsets: Dict[int, Set[int]] = {}  # 已收到的数据块偏移量
+        self.remaining: Dict[int, int] = {}  # 尚未写入的字节数
+        # 数据块由写入线程落盘, 接收循环只负责分发
+        n_writers = min(4, session.file_window)
+        self.writer = ChunkWriter(self.on_written, self.on_allocated,
+                                  n_writers,
+                                  session.credit_window // 4 // n_writers)
+        self.completions: Deque[Tuple[int, int, Optional[Exception]]] = deque()
+        # 正在预分配的文件: file_id: (文件描述符, 打开前是否已存在)
+        self.allocating: Dict[int, Tuple[int, bool]] = {}
+        self.allocated: Deque[Tuple[int, Optional[Exception]]] = deque()
+        # 无需校验和时, 连接池可将数据块直接写入正在写入的文件
+        if session.chksum == 'none' and hasattr(os, 'splice'):
+            self.conn_pool.sink = self.open_sink
         self.trans_progress_tasks: Dict[int, TaskID] = {}
 
     def check_dst_path(self):
@@ -403,10 +754,48 @@ class Receiver(Thread):
             # 确保保存目录存在
             self.base_dir.mkdir(mode=0o755, parents=True, exist_ok=True)
 
+    def open_file(self, f_id: int):
+        '''打开文件, 交给写入线程预分配磁盘空间'''
+        f_info = self.files[f_id]
+        # 确保文件的上级目录存在
+        f_info.abspath.parent.mkdir(mode=0o755, parents=True, exist_ok=True)
+        existed = f_info.abspath.exists()
+        fd = os.open(f_info.abspath, os.O_WRONLY | os.O_CREAT, 0o666)
+        self.allocating[f_id] = (fd, existed)
+        self.writer.allocate(f_id, fd, f_info)
+
+    def start_file(self, f_id: int):
+        '''文件开始写入: 预分配完成后登记 fd, 供写入线程和连接池共用'''
+        fd, _ = self.allocating.pop(f_id)
+        with self.fd_lock:
+            self.fds[f_id] = fd
+        self.offsets[f_id] = set()
+        self.remaining[f_id] = self.files[f_id].size
+        self.conn_pool.expect(f_id)
+
+    def close_file(self, f_id: int):
+        '''文件结束写入 (完成或失败), 释放并发计数器'''
+        self.conn_pool.finish(f_id)
+        with self.fd_lock:
+            fd = self.fds.pop(f_id)
+        self.writer.close(f_id, fd)
+        self.offsets.pop(f_id)
+        self.remaining.pop(f_id)
+        self.concurrency.release()
+
+    def open_sink(self, f_id: int) -> Optional[int]:
+        '''供连接池调用: 返回文件描述符的副本 (由连接池关闭),
+        文件不在写入中时返回 None, 数据块照常交给 Receiver'''
+        with self.fd_lock:
+            fd = self.fds.get(f_id)
+            return None if fd is None else os.dup(fd)
+
     def process_dir_info(self, packet: Packet):
         '''处理目录信息报文'''
-        # 创建目录
-        d_info = DirInfo(*packet.unpack_body())
+        self.process_dir(DirInfo(*packet.unpack_body()))
+
+    def process_dir(self, d_info: DirInfo):
+        '''创建目录'''
         d_info.set_parent(self.base_dir)
         d_info.make()
         logging.info(f'[Receiver] Dir ready: {d_info}')
@@ -414,36 +803,78 @@ class Receiver(Thread):
         self.n_recv += 1
 
     def ready_notice(self):
-        '''通知对端文件准备就绪'''
+        '''打开待写入的文件, 预分配完成后由 process_completions 通知对端'''
         while self.ready_files:
             if self.concurrency.acquire(False):
-                f_id = self.ready_files[0]
-                f_info = self.files[f_id]
-                # 创建写入迭代器
-                self.iwriters[f_id] = f_info.iwrite()
-                self.iwriters[f_id].send(None)
-
-                # 通知对端：文件准备就绪
-                logging.debug(f'[Receiver] File({f_id}) ready')
-                ready_pkt = Packet.load(Flag.FILE_READY, f_id)
-                self.conn_pool.send(ready_pkt)
-                self.ready_files.popleft()
-
-                # 添加进度条任务
-                task_id = trans_progress.add_task(
-                    f'download-{f_info.name}',
-                    filename=f_info.name,
-                    total=f_info.size,
-                    start=True
-                )
-                self.trans_progress_tasks[f_id] = task_id
+                f_id = self.ready_files.popleft()
+                try:
+                    self.open_file(f_id)
+                except OSError as e:
+                    self.cannot_write(f_id, e)
             else:
                 break
 
+    def cannot_write(self, f_id: int, error: Exception):
+        '''文件无法写入 (如磁盘空间不足), 该文件不再通知对端发送'''
+        logging.error(f'[Receiver] Cannot write '
+                      f'{self.files[f_id].s_relpath}: {error}')
+        self.concurrency.release()
+        self.n_recv += 1
+
+    def on_allocated(self, f_id: int, error: Optional[Exception]):
+        '''写入线程的回调: 唤醒接收循环处理预分配结果'''
+        self.allocated.append((f_id, error))
+        self.conn_pool.wake()
+
+    def process_allocated(self):
+        '''处理预分配完成的文件, 通知对端文件准备就绪'''
+        ready_ids = []
+        while self.allocated:
+            f_id, error = self.allocated.popleft()
+            f_info = self.files[f_id]
+            if error is not None:
+                fd, existed = self.allocating.pop(f_id)
+                os.close(fd)
+                if not existed:
+                    f_info.abspath.unlink()
+                self.cannot_write(f_id, error)
+                continue
+
+            self.start_file(f_id)
+            ready_ids.append(f_id)
+            logging.debug(f'[Receiver] File({f_id}) ready')
+
+            # 添加进度条任务
+            task_id = trans_progress.add_task(
+                f'download-{f_info.name}',
+                filename=f_info.name,
+                total=f_info.size,
+                start=True
+            )
+            self.trans_progress_tasks[f_id] = task_id
+
+        # 通知对端：文件准备就绪 (一个报文通知多个文件)
+        if ready_ids:
+            ready_pkt = Packet.load(Flag.FILE_READY, *ready_ids)
+            self.conn_pool.send(ready_pkt)
+
     def process_file_info(self, packet: Packet):
         '''处理文件信息报文'''
         # 解包，并创建 FileInfo 对象
-        f_info = FileInfo(*packet.unpack_body())
+        self.process_file(FileInfo(*packet.unpack_body()))
+        self.ready_notice()
+
+    def process_manifest(self, packet: Packet):
+        '''批量处理目录、文件信息'''
+        for entry in packet.unpack_body():
+            if len(entry) == 3:
+                self.process_dir(DirInfo(*entry))
+            else:
+                self.process_file(FileInfo(*entry))
+        self.ready_notice()
+
+    def process_file(self, f_info: FileInfo):
+        '''处理文件信息'''
         if self.use_custom_name:
             f_info.abspath = self.dst_path
         else:
@@ -459,77 +890,109 @@ class Receiver(Thread):
                 self.files[f_info.id] = f_info
                 self.size += f_info.size
                 self.ready_files.append(f_info.id)  # 将 f_id 加入待通知队列
-                self.ready_notice()
             else:
                 # 传输的是空文件，直接标记为完成
                 f_info.touch()
                 self.n_recv += 1
                 logging.info(f'[Receiver] File finished: {f_info.s_relpath}')
 
-    def get_iwriter(self, f_id):
-        '''获取写入迭代器'''
-        if f_id not in self.iwriters:
-            f_info = self.files[f_id]
-            # 创建并启动写入迭代器
-            self.iwriters[f_id] = f_info.iwrite()
-            self.iwriters[f_id].send(None)
-        return self.iwriters[f_id]
-
     def process_file_chunk(self, packet: Packet):
-        '''处理文件数据块'''
-        f_id, seq, chunk = packet.unpack_body()
-        try:
-            logging.debug(f'[Receiver] Write chunk({seq}) '
-                          f'into {self.files[f_id].s_relpath}')
-            iwriter = self.get_iwriter(f_id)
-            trans_progress.update(self.trans_progress_tasks[f_id],
-                                  advance=len(chunk))
-            iwriter.send((seq, chunk))
-        except StopIteration:
-            # 释放并发计数器
-            self.concurrency.release()
-            # 检查文件 Hash
-            if self.files[f_id].is_vaild():
-                self.files[f_id].set_stat()  # 修改文件状态
+        '''处理文件数据块: 交给写入线程'''
+        f_id, offset, *_ = packet.unpack_body()
+        offsets = self.offsets.get(f_id)
+        if offsets is None or offset in offsets:
+            # 文件已接收完毕, 连接断开后重发的数据块可能重复到达
+            self.conn_pool.release(packet)
+            return
+        offsets.add(offset)
+
+        logging.debug(f'[Receiver] Write chunk(@{offset}) '
+                      f'into {self.files[f_id].s_relpath}')
+        if isinstance(packet.payload, FileRange):
+            # 已由连接池写入文件
+            self.conn_pool.release(packet)
+            self.file_written(f_id, len(packet.payload))
+        else:
+            self.writer.write(f_id, self.fds[f_id], offset, packet)
+
+    def on_written(self, f_id: int, packet: Packet, n_bytes: int,
+                   error: Optional[Exception]):
+        '''写入线程的回调: 归还报文, 唤醒接收循环处理写入结果'''
+        self.conn_pool.release(packet)
+        self.completions.append((f_id, n_bytes, error))
+        self.conn_pool.wake()
+
+    def process_completions(self):
+        '''处理写入线程完成的预分配和数据块'''
+        self.process_allocated()
+        while self.completions:
+            f_id, n_bytes, error = self.completions.popleft()
+            if f_id not in self.remaining:
+                continue  # 文件已写入失败
+            elif error is not None:
+                logging.error(f'[Receiver] Write failed: '
+                              f'{self.files[f_id].s_relpath}: {error}')
+                self.close_file(f_id)
                 self.n_recv += 1
-                self.iwriters.pop(f_id)
-                self.ready_notice()
-                logging.info(f'[Receiver] File finished: '
-                             f'{self.files[f_id].s_relpath}')
             else:
-                logging.error(f'[Receiver] Bad file hash: '
-                              f'{self.files[f_id].s_relpath}')
+                self.file_written(f_id, n_bytes)
+
+    def file_written(self, f_id: int, n_bytes: int):
+        '''数据块已落盘, 文件写满后检查并设置文件状态'''
+        trans_progress.update(self.trans_progress_tasks[f_id], advance=n_bytes)
+        self.remaining[f_id] -= n_bytes
+        if self.remaining[f_id] > 0:
+            return
 
-        return len(chunk)
+        self.close_file(f_id)
+        f_info = self.files[f_id]
+        # 检查文件 Hash (发送端未提供 Hash 时不检查)
+        if not f_info.chksum or f_info.is_vaild():
+            f_info.set_stat()  # 修改文件状态
+            self.n_recv += 1
+            self.ready_notice()
+            logging.info(f'[Receiver] File finished: {f_info.s_relpath}')
+        else:
+            logging.error(f'[Receiver] Bad file hash: {f_info.s_relpath}')
 
     def run(self):
         logging.debug(f'Receiver-{self.sid.hex()[:8]} is running')
         self.conn_pool.start()  # 启动连接池
+        self.writer.start()  # 启动写入线程
 
-        # 等待接收文件总数数据包
+        # 等待接收传输模式报文
+        # 多个连接并行时, 后续报文可能先于它到达, 先暂存起来
         logging.debug('[Receiver] Waitting for translation mode')
-        packet = self.conn_pool.recv()
-        if packet.flag == Flag.MONOFILE:
-            # 取出文件总数，并确认目标路径
-            self.is_monofile, = packet.unpack_body()
-            logging.debug(f'[Receiver] Is monofile: {self.is_monofile}.')
-            self.check_dst_path()
-        else:
-            logging.error(f'[Receiver] The first packet must be `MONOFILE` '
-                          f'but receive `{packet.flag.name}`')
-            exit_pkt = Packet.load(Flag.EXCEPTION, 'packet type error.')
-            self.conn_pool.send(exit_pkt)
-            return
+        early_packets: Deque[Packet] = deque()
+        while True:
+            packet = self.conn_pool.recv()
+            if packet.flag == Flag.MONOFILE:
+                break
+            early_packets.append(packet)
+
+        # 确认目标路径
+        self.is_monofile, = packet.unpack_body()
+        logging.debug(f'[Receiver] Is monofile: {self.is_monofile}.')
+        self.check_dst_path()
 
         # 等待接收文件信息和数据
         while self.n_recv < self.total:
-            packet = self.conn_pool.recv()
-            if packet.flag == Flag.DIR_INFO:
+            if early_packets:
+                packet = early_packets.popleft()
+            else:
+                packet = self.conn_pool.recv()
+            if packet is None:
+                self.process_completions()  # 由写入线程唤醒
+
+            elif packet.flag == Flag.DIR_INFO:
                 self.process_dir_info(packet)
 
             elif packet.flag == Flag.FILE_INFO:
                 self.process_file_info(packet)
 
+            elif packet.flag == Flag.MANIFEST:
+                self.process_manifest(packet)
+
             elif packet.flag == Flag.FILE_CHUNK:
                 self.process_file_chunk(packet)
 
@@ -544,8 +1007,14 @@ class Receiver(Thread):
             else:
                 logging.error(f'[Receiver] Unknow packet flag: {packet.flag}')
 
-        self.conn_pool.send(Packet.load(Flag.DONE))
+        self.conn_pool.send(Packet.load(Flag.DONE, True))
         logging.info('[Receiver] All files finished.')
+        for f_id in list(self.fds):
+            self.close_file(f_id)
+        self.writer.shutdown()
+        # 对端异常退出时, 可能仍有文件在预分配
+        for fd, _ in self.allocating.values():
+            os.close(fd)
 
         self.conn_pool.stop()
         logging.info(f'Receiver-{self.sid.hex()[:8]} exit')
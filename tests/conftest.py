@@ -0,0 +1,58 @@
+'''测试用的本机 fcpd'''
+import socket
+from json import dumps, loads
+from time import sleep
+
+import pytest
+
+from fastcopy.network import Flag, Packet, Session, recv_pkt, send_pkt
+from fastcopy.server import Server
+from fastcopy.transfer import Sender
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def connect(port: int, retries=100) -> socket.socket:
+    '''连接 fcpd, 等待其开始监听'''
+    for _ in range(retries):
+        try:
+            return socket.create_connection(('127.0.0.1', port))
+        except ConnectionRefusedError:
+            sleep(0.05)
+    raise RuntimeError('fcpd did not start')
+
+
+@pytest.fixture
+def server(request) -> int:
+    '''在后台线程中启动 fcpd, 返回其端口 (可经 indirect 参数指定连接池实现)'''
+    port = free_port()
+    srv = Server(16, getattr(request, 'param', 'thread'))
+    srv.addr = ('127.0.0.1', port)
+    srv.start()
+    return port
+
+
+def push(port: int, srcs, dst: str, timeout=60, engine='thread',
+         **params) -> Sender:
+    '''按 fcp 的握手流程推送 srcs 到 dst, 返回已结束 (或超时) 的 Sender'''
+    session = Session(**params)
+    request = {'dst': dst, 'params': session.to_dict()}
+    conn = connect(port)
+    send_pkt(conn, Packet.load(Flag.PUSH, dumps(request)))
+    session_id, params = recv_pkt(conn).unpack_body()
+    session = Session(**loads(params))
+
+    sender = Sender(session_id, [str(src) for src in srcs], session,
+                    engine=engine)
+    sender.conn_pool.add(conn)
+    sender.start()
+    for _ in range(session.max_channels - 1):
+        conn = connect(port)
+        send_pkt(conn, Packet.load(Flag.ATTACH, session_id))
+        sender.conn_pool.add(conn)
+    sender.join(timeout)
+    return sender
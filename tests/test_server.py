@@ -0,0 +1,23 @@
+from json import dumps
+from struct import Struct
+from zlib import crc32
+
+from fastcopy.network import Flag, Session, recv_pkt
+
+from conftest import connect
+
+HEAD_V2 = Struct('>BBII')  # 版本 2 的报头: version | flag | chksum | length
+
+
+def test_version_mismatch_gets_exception(server, tmp_path):
+    '''旧版本客户端的握手得到 EXCEPTION 回复, 而不是直接断开'''
+    request = {'dst': str(tmp_path), 'params': Session().to_dict()}
+    body = dumps(request).encode()
+    head = HEAD_V2.pack(2, Flag.PUSH, crc32(body), len(body))
+    with connect(server) as sock:
+        sock.sendall(head + body)
+        reply = recv_pkt(sock)
+
+    assert reply.flag == Flag.EXCEPTION
+    msg, = reply.unpack_body()
+    assert 'protocol version mismatch' in msg
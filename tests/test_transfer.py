@@ -0,0 +1,49 @@
+import logging
+import os
+import resource
+from time import sleep
+
+import pytest
+
+from conftest import push
+
+
+def test_sendfile_many_files_over_fd_limit(server, tmp_path):
+    '''chksum 为 none 时 (os.sendfile) 文件数超过 RLIMIT_NOFILE 仍能传完'''
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    limit = min(soft, 256)
+    src = tmp_path / 'src'
+    src.mkdir()
+    contents = {}
+    for i in range(limit + 200):
+        contents[f'f{i}'] = os.urandom(8192)
+        (src / f'f{i}').write_bytes(contents[f'f{i}'])
+
+    resource.setrlimit(resource.RLIMIT_NOFILE, (limit, hard))
+    try:
+        sender = push(server, [src], str(tmp_path / 'dst'), chksum='none',
+                      max_channels=2)
+    finally:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+
+    assert not sender.is_alive()
+    dst = tmp_path / 'dst'
+    assert {p.name: p.read_bytes() for p in dst.iterdir()} == contents
+
+
+@pytest.mark.parametrize('server', ['asyncio'], indirect=True)
+def test_asyncio_session_end_without_warnings(server, tmp_path, caplog):
+    '''会话正常结束后双方关闭连接, 不应当作连接故障告警或重发'''
+    src = tmp_path / 'src'
+    src.mkdir()
+    for i in range(20):
+        (src / f'f{i}').write_bytes(os.urandom(300 * 1024))
+
+    caplog.set_level(logging.WARNING)
+    for i in range(10):
+        sender = push(server, [src], str(tmp_path / f'dst{i}'),
+                      engine='asyncio', max_channels=4)
+        assert not sender.is_alive()
+    sleep(0.5)  # 等待 fcpd 一侧的连接池停止
+    assert not [r.getMessage() for r in caplog.records
+                if r.levelno >= logging.WARNING]